@@ -0,0 +1,14 @@
+import os
+
+# the web process in the Procfile. eventlet workers give socket.io real
+# websockets, so an open tab holds a connection rather than a thread
+worker_class = 'eventlet'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# socket.io rooms live in each worker's memory. with more than one worker a
+# push would only reach the tabs connected to the worker that sent it, so
+# refuse to start without a shared message queue
+def on_starting(server):
+	if server.cfg.workers > 1 and not os.environ.get('SOCKETIO_MESSAGE_QUEUE'):
+		raise RuntimeError('{} workers need SOCKETIO_MESSAGE_QUEUE (e.g. a redis:// url) '
+			'so socket.io pushes reach every worker'.format(server.cfg.workers))
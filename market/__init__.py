@@ -9,29 +9,80 @@ from flask_moment import Moment
 from flask_bootstrap import Bootstrap
 from flask_pagedown import PageDown
 from flask_socketio import SocketIO, emit
+from market.database import database_uri, engine_options, configure_sqlite
 
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '0a383bdacfada9ed7b9603837f78bb71'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri(os.environ.get('DATABASE_URL', 'sqlite:///site.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5)) #per worker process
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = int(os.environ.get('DB_POOL_TIMEOUT', 10)) #seconds to wait for a free connection
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800)) #seconds, server databases only
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0)) #ms, postgres only; 0 is no limit
+app.config['SQLITE_BUSY_TIMEOUT'] = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)) #ms a writer waits for the lock
+app.config['SQLITE_MMAP_SIZE'] = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)) #bytes
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+app.config['POSTS_PER_PAGE'] = int(os.environ.get('POSTS_PER_PAGE', 24))
+app.config['POSTS_PER_PAGE_MAX'] = int(os.environ.get('POSTS_PER_PAGE_MAX', 60))
+app.config['PRESENCE_FLUSH_INTERVAL'] = int(os.environ.get('PRESENCE_FLUSH_INTERVAL', 60)) #seconds between last_seen writes
+app.config['PRESENCE_STALE_AFTER'] = int(os.environ.get('PRESENCE_STALE_AFTER', 300)) #flush early past this
+app.config['DEFAULT_CURRENCY'] = os.environ.get('DEFAULT_CURRENCY', 'USD') #for prices typed without a symbol or code
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 50))
+app.config['IMAGE_WORKERS'] = int(os.environ.get('IMAGE_WORKERS', 2)) #0 processes uploads inline
+app.config['IMAGE_QUEUE_DEPTH'] = int(os.environ.get('IMAGE_QUEUE_DEPTH', 100))
+app.config['UPLOAD_STAGING_DIR'] = os.environ.get('UPLOAD_STAGING_DIR', os.path.join(app.instance_path, 'uploads'))
+app.config['DIRECTORY_MAX_ENTRIES'] = int(os.environ.get('DIRECTORY_MAX_ENTRIES', 5000))
+app.config['DIRECTORY_TTL'] = int(os.environ.get('DIRECTORY_TTL', 300)) #seconds
+app.config['TRENDING_TAGS_WINDOW'] = int(os.environ.get('TRENDING_TAGS_WINDOW', 7)) #days
+app.config['TRENDING_TAGS_TTL'] = int(os.environ.get('TRENDING_TAGS_TTL', 300)) #seconds
+app.config['FRAGMENT_CACHE'] = os.environ.get('FRAGMENT_CACHE', 'memory') #memory, null or a redis:// url
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 2000)) #entries, memory backend only
+app.config['FRAGMENT_CACHE_TTL'] = int(os.environ.get('FRAGMENT_CACHE_TTL', 3600)) #seconds
+app.config['TIMELINE_ENABLED'] = os.environ.get('TIMELINE_ENABLED', '1') == '1' #0 builds the following feed on read
+app.config['TIMELINE_MAX_ENTRIES'] = int(os.environ.get('TIMELINE_MAX_ENTRIES', 800)) #per user; older pages are built on read
+app.config['TIMELINE_FANOUT_LIMIT'] = int(os.environ.get('TIMELINE_FANOUT_LIMIT', 1000)) #sellers with more followers are merged in on read
+app.config['IDENTITY_CACHE'] = os.environ.get('IDENTITY_CACHE', 'memory') #memory, null or a redis:// url shared by the workers
+app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', 10000)) #signed in users, memory backend only
+app.config['IDENTITY_CACHE_TTL'] = int(os.environ.get('IDENTITY_CACHE_TTL', 60)) #seconds; bounds staleness across workers
+app.config['STATIC_ASSETS'] = os.environ.get('STATIC_ASSETS', '1') == '1' #link the hashed copies from `flask build-assets`
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE') #e.g. redis://, needed with more than one worker process (WEB_CONCURRENCY > 1)
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING_ENABLED', '1') == '1' #per request query counts and /metrics
+app.config['PROFILING_HEADERS'] = os.environ.get('PROFILING_HEADERS', '1') == '1' #Server-Timing and X-Query-Count headers
+app.config['SLOW_REQUEST_MS'] = int(os.environ.get('SLOW_REQUEST_MS', 500)) #slower requests are logged
+app.config['N_PLUS_ONE_THRESHOLD'] = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 10)) #runs of one statement in a request
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN') #bearer token for /metrics; unset allows localhost only
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+configure_sqlite(app)
+migrate = Migrate(app, db, render_as_batch=True)
 bcrypt = Bcrypt(app)
 moment = Moment(app)
 bootstrap = Bootstrap(app)
 pagedown = PageDown(app)
-socketio = SocketIO(app)
+socketio = SocketIO(app, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message_category = 'info'
-app.config['MAIL_SERVER'] = 'smtp.gmail.com'
-app.config['MAIL_PORT'] = 587
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER', 'smtp.gmail.com') #localhost for a debugging smtp server
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT', 587))
+app.config['MAIL_USE_TLS'] = os.environ.get('MAIL_USE_TLS', '1') == '1'
 app.config['MAIL_USERNAME'] = os.environ.get('EMAIL_USER') #set recovery email
 app.config['MAIL_PASSWORD'] = os.environ.get('EMAIL_PASS') #set recovery email password
+app.config['MAIL_DEFAULT_SENDER'] = os.environ.get('MAIL_DEFAULT_SENDER', app.config['MAIL_USERNAME'] or 'noreply@localhost')
+app.config['MAIL_WORKER'] = os.environ.get('MAIL_WORKER', '1') == '1' #0 leaves the outbox to `flask send-mail`
+app.config['MAIL_BATCH_SIZE'] = int(os.environ.get('MAIL_BATCH_SIZE', 50)) #messages per smtp connection
+app.config['MAIL_POLL_INTERVAL'] = int(os.environ.get('MAIL_POLL_INTERVAL', 30)) #seconds between checks for retries
+app.config['MAIL_MAX_ATTEMPTS'] = int(os.environ.get('MAIL_MAX_ATTEMPTS', 8))
+app.config['MAIL_RETRY_DELAY'] = int(os.environ.get('MAIL_RETRY_DELAY', 30)) #seconds before the first retry, doubling after
+app.config['MAIL_RETRY_MAX_DELAY'] = int(os.environ.get('MAIL_RETRY_MAX_DELAY', 3600))
+app.config['MAIL_CLAIM_TIMEOUT'] = int(os.environ.get('MAIL_CLAIM_TIMEOUT', 300)) #seconds before a stuck batch is sent again
+app.config['MAIL_TIMEOUT'] = int(os.environ.get('MAIL_TIMEOUT', 30)) #smtp socket timeout, seconds
+app.config['PURGE_WORKERS'] = int(os.environ.get('PURGE_WORKERS', 1)) #0 runs account and post deletions inline
+app.config['PURGE_BATCH_SIZE'] = int(os.environ.get('PURGE_BATCH_SIZE', 500)) #rows per delete transaction
+app.config['PURGE_BATCH_PAUSE'] = float(os.environ.get('PURGE_BATCH_PAUSE', 0.05)) #seconds between batches
 mail = Mail(app)
 
 
 
-from market import routes, models
+from market import profiling, identity, assets, outbox, purge, routes, models, commands
@@ -0,0 +1,167 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+from flask import request, send_from_directory
+from market import app
+
+# the stylesheet and the images under resources/ are copied into static/dist
+# with a hash of their content in the name (main.css -> dist/main.1a2b3c4d5e6f.css),
+# next to brotli and gzip copies, and dist/manifest.json maps each original
+# name to its copy. url_for('static', filename='main.css') then links the
+# copy: its url never changes meaning, so browsers keep it for a year without
+# revalidating, and the next build that changes the file changes the url.
+# uploads are content addressed already and are left alone. without a
+# manifest (e.g. in development before `flask build-assets`) urls are untouched.
+ASSET_SOURCES = ('main.css', 'resources')
+DIST = 'dist'
+MIN_SAVING = 0.9 #keep a compressed copy only when it is under 90% of the original
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+#in requirements.txt; a checkout without it still builds the gzip copies
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# (content-encoding, suffix, compress), in order of preference
+ENCODINGS = [('gzip', '.gz', lambda data: gzip.compress(data, 9))]
+if brotli is not None:
+	ENCODINGS.insert(0, ('br', '.br', lambda data: brotli.compress(data, quality=11)))
+
+
+def dist_dir():
+	return os.path.join(app.static_folder, DIST)
+
+def manifest_path():
+	return os.path.join(dist_dir(), 'manifest.json')
+
+def hashed_name(filename, data):
+	stem, ext = os.path.splitext(filename)
+	return '{}.{}{}'.format(stem, hashlib.sha256(data).hexdigest()[:12], ext)
+
+# paths relative to static/, skipping dotfiles like .DS_Store
+def source_files():
+	for source in ASSET_SOURCES:
+		path = os.path.join(app.static_folder, source)
+		if os.path.isfile(path):
+			yield source
+		for root, dirs, files in os.walk(path):
+			dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+			for name in sorted(files):
+				if not name.startswith('.'):
+					yield os.path.relpath(os.path.join(root, name), app.static_folder).replace(os.sep, '/')
+
+def _write(path, data):
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as f:
+		f.write(data)
+	os.replace(tmp, path)
+
+
+# hashes and compresses every asset and writes the manifest last, so a
+# running server keeps resolving the previous build until it has a complete
+# new one. copies from earlier builds are kept for pages already in
+# browsers, unless `prune` is set
+def build_assets(prune=False, log=print):
+	files, encodings = {}, {}
+	for filename in source_files():
+		with open(os.path.join(app.static_folder, filename), 'rb') as f:
+			data = f.read()
+		name = hashed_name(filename, data)
+		path = os.path.join(dist_dir(), name)
+		if not os.path.exists(path):
+			_write(path, data)
+		files[filename] = name
+		encodings[name] = []
+		for encoding, suffix, compress in ENCODINGS:
+			if not os.path.exists(path + suffix):
+				compressed = compress(data)
+				if len(compressed) >= len(data) * MIN_SAVING:
+					continue
+				_write(path + suffix, compressed)
+			encodings[name].append(encoding)
+		log('{} -> {}/{} {}'.format(filename, DIST, name, ' '.join(encodings[name])).rstrip())
+	_write(manifest_path(), json.dumps({'files': files, 'encodings': encodings}, indent=2, sort_keys=True).encode())
+	removed = []
+	if prune:
+		suffixes = {encoding: suffix for encoding, suffix, compress in ENCODINGS}
+		keep = {manifest_path()}
+		for name, built in encodings.items():
+			keep.add(os.path.join(dist_dir(), name))
+			keep.update(os.path.join(dist_dir(), name) + suffixes[encoding] for encoding in built)
+		for root, dirs, names in os.walk(dist_dir()):
+			for name in names:
+				path = os.path.join(root, name)
+				if path not in keep:
+					os.remove(path)
+					removed.append(path)
+	if brotli is None:
+		log('brotli is not installed; built gzip copies only.')
+	return files, removed
+
+
+class Manifest(object):
+
+	def __init__(self, path):
+		self.path = path
+		self.mtime = None
+		self.files = {}
+		self.encodings = {}
+
+	# reread the file if it changed since the last load
+	def refresh(self):
+		try:
+			mtime = os.path.getmtime(self.path)
+		except OSError:
+			mtime = None
+		if mtime == self.mtime:
+			return
+		data = {}
+		if mtime is not None:
+			with open(self.path) as f:
+				data = json.load(f)
+		self.files = data.get('files', {})
+		self.encodings = data.get('encodings', {})
+		self.mtime = mtime
+
+manifest = Manifest(manifest_path())
+manifest.refresh()
+
+
+# workers read the manifest once at start; the debug server rereads it when
+# it changes, so a build shows up without a restart
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+	if endpoint != 'static' or not app.config['STATIC_ASSETS']:
+		return
+	if app.debug:
+		manifest.refresh()
+	name = manifest.files.get(values.get('filename'))
+	if name is not None:
+		values['filename'] = '{}/{}'.format(DIST, name)
+
+
+# the static endpoint, with built assets sent precompressed when the browser
+# accepts it. behind nginx the same layout works with gzip_static/brotli_static
+def serve_static(filename):
+	if not filename.startswith(DIST + '/'):
+		return app.send_static_file(filename)
+	name = filename[len(DIST) + 1:]
+	available = manifest.encodings.get(name, ())
+	mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+	for encoding, suffix, compress in ENCODINGS:
+		if encoding in available and request.accept_encodings[encoding]:
+			response = send_from_directory(dist_dir(), name + suffix, mimetype=mimetype)
+			response.headers['Content-Encoding'] = encoding
+			break
+	else:
+		response = send_from_directory(dist_dir(), name, mimetype=mimetype)
+	if available:
+		response.vary.add('Accept-Encoding')
+	response.headers['Cache-Control'] = IMMUTABLE
+	return response
+
+app.view_functions['static'] = serve_static
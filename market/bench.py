@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime
+from flask import session
+from flask_login import login_user
+from sqlalchemy import event, func
+from market import app, db
+from market.models import User, Post, Conversation, Tag
+from market.pagination import encode_cursor, encode_price_cursor
+
+# the pages behind most traffic; {me}, {other}, {post}, {tag} and {cursor}
+# are filled in from the database. results are keyed by these templates, so a
+# baseline taken on one dataset can be compared with a run on another
+BENCH_PAGES = ['/home', '/home?cursor={cursor}', '/following', '/{me}', '/{other}', '/{me}/likes',
+	'/post/{post}', '/messages', '/m/{other}', '/tag/{tag}', '/search?q={tag}', '/browse']
+
+
+# real rows for the page templates, seen by `me`: someone they have talked
+# to, the newest post, any tag and a priced post
+def page_values(me):
+	conversation = Conversation.query.filter(Conversation.involving(me.id),
+		Conversation.user_a_id != Conversation.user_b_id).first()
+	other = conversation.other(me) if conversation else User.query.filter(User.id != me.id).first()
+	post = Post.query.order_by(Post.date_posted.desc(), Post.id.desc()).first()
+	tag = Tag.query.first()
+	priced = Post.query.filter(Post.price_amount.isnot(None)).first()
+	return {'me': me.username, 'other': other.username if other else me.username,
+		'post': post.id if post else 0, 'tag': tag.name if tag else 'a',
+		'cursor': encode_cursor(post.date_posted, post.id) if post else '',
+		'price_cursor': encode_price_cursor(priced) if priced else ''}
+
+# the session of a signed-in browser, written by flask-login itself so the
+# keys match whichever version is installed (0.4 reads 'user_id', 0.5 '_user_id')
+def login_session(user):
+	with app.test_request_context():
+		login_user(user)
+		return dict(session)
+
+def percentile(samples, p):
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+# drives the app in process through the test client, counting queries with
+# an engine listener. requests are sequential
+class TestClientDriver(object):
+	concurrency = 1
+
+	def __init__(self, user):
+		self.client = app.test_client()
+		with self.client.session_transaction() as client_session:
+			client_session.update(login_session(user))
+		self.queries = 0
+		event.listen(db.engine, 'before_cursor_execute', self.count)
+
+	def count(self, *args):
+		self.queries += 1
+
+	def get(self, path):
+		self.queries = 0
+		started = time.perf_counter()
+		status = self.client.get(path).status_code
+		return status, time.perf_counter() - started, self.queries
+
+	def close(self):
+		event.remove(db.engine, 'before_cursor_execute', self.count)
+
+
+# drives a running server, e.g. gunicorn on localhost, with several clients
+# at once. the session cookie is signed here, so the server must share this
+# SECRET_KEY and database; query counts come from its X-Query-Count header
+class ServerDriver(object):
+
+	def __init__(self, base_url, user, concurrency=1):
+		self.base_url = base_url.rstrip('/')
+		self.concurrency = concurrency
+		cookie = app.session_interface.get_signing_serializer(app).dumps(login_session(user))
+		self.cookie = '{}={}'.format(app.session_cookie_name, cookie)
+
+	def get(self, path):
+		request = urllib.request.Request(self.base_url + path, headers={'Cookie': self.cookie})
+		started = time.perf_counter()
+		try:
+			with urllib.request.urlopen(request, timeout=30) as response:
+				response.read()
+				status, queries = response.status, response.headers.get('X-Query-Count')
+		except urllib.error.HTTPError as e:
+			status, queries = e.code, e.headers.get('X-Query-Count')
+		elapsed = time.perf_counter() - started
+		return status, elapsed, int(queries) if queries is not None else None
+
+	def close(self):
+		pass
+
+
+# `count` requests for one path, spread over the driver's clients
+def _measure(driver, path, count):
+	samples, queries, statuses = [], [], []
+	lock = threading.Lock()
+	remaining = iter(range(count))
+
+	def client():
+		while True:
+			with lock:
+				if next(remaining, None) is None:
+					return
+			status, elapsed, query_count = driver.get(path)
+			with lock:
+				samples.append(elapsed)
+				statuses.append(status)
+				if query_count is not None:
+					queries.append(query_count)
+
+	threads = [threading.Thread(target=client) for _ in range(driver.concurrency)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	#every page is a 200 for a signed-in user; a redirect (e.g. to /login)
+	#would time the wrong thing
+	return samples, queries, sum(status != 200 for status in statuses)
+
+# p50/p99 latency and queries per request for every page
+def run_benchmark(driver, values, pages=BENCH_PAGES, requests=50, warmup=5):
+	results = {}
+	for page in pages:
+		path = page.format(**values)
+		_measure(driver, path, warmup)
+		samples, queries, errors = _measure(driver, path, requests)
+		results[page] = {'requests': len(samples), 'errors': errors,
+			'p50_ms': round(percentile(samples, 50) * 1000, 2),
+			'p99_ms': round(percentile(samples, 99) * 1000, 2),
+			'queries': max(queries) if queries else None}
+	return results
+
+def dataset():
+	return {'users': db.session.query(func.count(User.id)).scalar(),
+		'posts': db.session.query(func.count(Post.id)).scalar()}
+
+def save_results(path, results, mode):
+	with open(path, 'w') as f:
+		json.dump({'created': datetime.utcnow().isoformat(), 'mode': mode, 'dataset': dataset(),
+			'results': results}, f, indent=2, sort_keys=True)
+
+# more queries than the baseline is always a regression; latency only when
+# p99 is past the tolerance and more than a few ms slower, since small
+# timings are mostly noise
+def regressions(results, baseline, tolerance=0.25, floor_ms=10.0):
+	found = []
+	for page, result in results.items():
+		before = baseline['results'].get(page)
+		if before is None:
+			continue
+		if result['queries'] is not None and before['queries'] is not None and result['queries'] > before['queries']:
+			found.append('{}: {} queries, baseline {}'.format(page, result['queries'], before['queries']))
+		if result['p99_ms'] > before['p99_ms'] * (1 + tolerance) and result['p99_ms'] - before['p99_ms'] > floor_ms:
+			found.append('{}: p99 {}ms, baseline {}ms'.format(page, result['p99_ms'], before['p99_ms']))
+		if result['errors'] > before['errors']:
+			found.append('{}: {} errors, baseline {}'.format(page, result['errors'], before['errors']))
+	return found
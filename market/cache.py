@@ -0,0 +1,45 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# small in-process cache: least recently used entries are evicted past
+# maxsize, and every entry expires after ttl seconds
+class TTLCache(object):
+
+	def __init__(self, maxsize=1024, ttl=60):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.data = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self.lock:
+			entry = self.data.get(key)
+			if entry is None:
+				return default
+			expires, value = entry
+			if expires < time.monotonic():
+				del self.data[key]
+				return default
+			self.data.move_to_end(key)
+			return value
+
+	def set(self, key, value, ttl=None):
+		expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+		with self.lock:
+			self.data[key] = (expires, value)
+			self.data.move_to_end(key)
+			while len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+	def delete(self, key):
+		with self.lock:
+			self.data.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.data.clear()
+
+	def __len__(self):
+		return len(self.data)
@@ -0,0 +1,293 @@
+import json
+import click
+from sqlalchemy import bindparam, event, func, select
+from market import app, db
+from market.models import User, Post, PostLike, Comment, Message, PurgeJob, followers
+from market.images import collect_garbage
+from market.search import fts_supported, rebuild_search_index
+from market.markup import render_markdown
+from market.database import is_sqlite, sqlite_pragmas
+from market.timeline import rebuild_timelines
+from market.seed import seed
+from market.assets import build_assets
+from market.outbox import outbox, enqueue
+from market.purge import run_purge, unfinished_jobs
+from market.bench import TestClientDriver, ServerDriver, login_session, page_values, run_benchmark, save_results, regressions
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+	"""Recompute the denormalized like, comment, follow and post counters."""
+	post, user = Post.__table__, User.__table__
+	like, comment = PostLike.__table__, Comment.__table__
+
+	def count(table, column, key):
+		return select([func.count()]).select_from(table).where(column == key).as_scalar()
+
+	db.session.execute(post.update().values(
+		likes_count=count(like, like.c.post_id, post.c.id),
+		comments_count=count(comment, comment.c.post_id, post.c.id)))
+	db.session.execute(user.update().values(
+		followers_count=count(followers, followers.c.followed_id, user.c.id),
+		following_count=count(followers, followers.c.follower_id, user.c.id),
+		posts_count=count(post, post.c.user_id, user.c.id)))
+	db.session.commit()
+	click.echo('Counters reconciled.')
+
+
+@app.cli.command('gc-images')
+@click.option('--grace', default=3600, help='Skip files modified in the last N seconds.')
+@click.option('--dry-run', is_flag=True, help='List what would be removed.')
+def gc_images(grace, dry_run):
+	"""Delete uploaded image files that no post or profile references."""
+	removed = collect_garbage(grace=grace, dry_run=dry_run)
+	for path in removed:
+		click.echo(path)
+	click.echo('{} {} file(s).'.format('Would remove' if dry_run else 'Removed', len(removed)))
+
+
+@app.cli.command('build-assets')
+@click.option('--prune', is_flag=True, help='Remove copies left by earlier builds.')
+def build_assets_command(prune):
+	"""Write content hashed, precompressed copies of the static assets to static/dist."""
+	files, removed = build_assets(prune=prune, log=click.echo)
+	click.echo('{} asset(s) built{}.'.format(len(files), ', {} old file(s) removed'.format(len(removed)) if prune else ''))
+
+
+@app.cli.command('send-mail')
+@click.option('--retry-failed', is_flag=True, help='Queue messages that were given up on again first.')
+def send_mail(retry_failed):
+	"""Send every due message in the mail outbox now."""
+	if retry_failed:
+		click.echo('{} failed message(s) queued again.'.format(outbox.retry_failed()))
+	result = outbox.drain()
+	stats = outbox.stats()
+	click.echo('Sent {completed}, will retry {retried}, gave up on {failed}.'.format(**result))
+	click.echo('{} message(s) still queued, {} undeliverable.'.format(stats['depth'], stats['undeliverable']))
+
+
+@app.cli.command('send-test-mail')
+@click.argument('address')
+def send_test_mail(address):
+	"""Queue a test email to ADDRESS and send it, e.g. to check MAIL_SERVER settings."""
+	enqueue('Test email', [address], 'This is a test email from {}.'.format(app.config['MAIL_SERVER']))
+	db.session.commit()
+	result = outbox.drain()
+	click.echo('Sent {completed}, will retry {retried}, gave up on {failed}.'.format(**result))
+
+
+@app.cli.command('run-purges')
+@click.option('--retry', is_flag=True, help='Also rerun jobs that failed or were cut short. Stop the app first, '
+	'or a job still running there runs twice.')
+def run_purges(retry):
+	"""Finish pending account and post deletions here, e.g. after a restart."""
+	for job_id in unfinished_jobs(retry):
+		run_purge(job_id)
+		job = PurgeJob.query.get(job_id)
+		click.echo('{} {} {}: {} row(s) deleted{}.'.format(job.kind, job.target_id, job.status, job.deleted,
+			', ' + job.error if job.error else ''))
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+	"""Create the post full text index if needed and rebuild it from every post."""
+	if not fts_supported():
+		click.echo('Full text search needs SQLite FTS5; this database falls back to LIKE queries.')
+		return
+	rebuild_search_index()
+	click.echo('Search index rebuilt.')
+
+
+# (model, source column, html column, sanitizer policy)
+RENDERED_COLUMNS = [
+	(User, 'bio', 'bio_html', 'bio'),
+	(Post, 'content', 'content_html', 'body'),
+	(Comment, 'body', 'body_html', 'body'),
+	(Message, 'body', 'body_html', 'body'),
+]
+
+@app.cli.command('rerender-markdown')
+@click.option('--batch-size', default=500, help='Rows read and written per round trip.')
+def rerender_markdown(batch_size):
+	"""Re-render the stored html of bios, posts, comments and messages, e.g. after the allowed tags change."""
+	for model, source, target, policy in RENDERED_COLUMNS:
+		table = model.__table__
+		last_id, changed = 0, 0
+		while True:
+			rows = db.session.execute(select([table.c.id, table.c[source], table.c[target]]).where(
+				table.c.id > last_id).order_by(table.c.id).limit(batch_size)).fetchall()
+			if not rows:
+				break
+			last_id = rows[-1][0]
+			updates = []
+			for row_id, text, html in rows:
+				rendered = render_markdown(text, policy)
+				if rendered != html:
+					updates.append({'row_id': row_id, 'html': rendered})
+			if updates:
+				db.session.execute(table.update().where(table.c.id == bindparam('row_id')).values(
+					{target: bindparam('html')}), updates)
+				db.session.commit()
+				changed += len(updates)
+		click.echo('{}: {} row(s) re-rendered.'.format(table.name, changed))
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+	"""Refill every user's following feed from the follow graph, e.g. after changing the timeline limits."""
+	rebuild_timelines()
+	click.echo('Timelines rebuilt.')
+
+
+@app.cli.command('db-check')
+def db_check():
+	"""Connect to the configured database and report its settings, for checking a deployment."""
+	engine = db.engine
+	click.echo('url:     {!r}'.format(engine.url)) #password masked
+	with engine.connect() as connection:
+		click.echo('dialect: {} {}'.format(engine.dialect.name, '.'.join(map(str, engine.dialect.server_version_info))))
+		click.echo('pool:    {} {}'.format(type(engine.pool).__name__, engine.pool.status()))
+		if is_sqlite(str(engine.url)):
+			for pragma in sqlite_pragmas(app.config):
+				name = pragma.split()[1].split('=')[0]
+				click.echo('{}: {}'.format(name, connection.execute('PRAGMA ' + name).scalar()))
+		elif engine.dialect.name == 'postgresql':
+			for setting in ('statement_timeout', 'max_connections', 'server_encoding'):
+				click.echo('{}: {}'.format(setting, connection.execute('SHOW ' + setting).scalar()))
+		click.echo('users:   {}'.format(connection.execute(select([func.count()]).select_from(User.__table__)).scalar()))
+
+
+# the pages behind most traffic, filled in by page_values (see market/bench.py)
+# so every query has real data to plan against
+EXPLAIN_PAGES = ['/home', '/home?cursor={cursor}', '/following', '/{me}', '/{other}', '/{me}/likes', '/post/{post}',
+	'/messages', '/m/{other}', '/tag/{tag}', '/search?q={tag}', '/search?q={tag}&max_price=500', '/browse',
+	'/browse?max_price=500&cursor={price_cursor}', '/browse?sort=price_desc', '/api/users?q={other}', '/account']
+
+# a virtual table does its own lookup, or sqlite reads one row
+PLANNED = ('VIRTUAL TABLE', 'CONSTANT ROW')
+
+def query_plan(connection, statement, parameters):
+	cursor = connection.connection.cursor()
+	cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+	plan = [row[-1] for row in cursor.fetchall()]
+	cursor.close()
+	return plan
+
+#"SCAN post" reads the whole table and "SCAN post USING INDEX ..." walks a
+#whole index. the one walk allowed is the first page of a plain ordered
+#listing, a statement with a LIMIT and no WHERE, which stops after LIMIT rows.
+#"SCAN anon_1" and "SCAN (subquery-1)" read a small result already built
+def is_full_scan(step, statement):
+	if not step.startswith('SCAN ') or step.startswith(('SCAN (', 'SCAN anon_')) \
+			or any(planned in step for planned in PLANNED):
+		return False
+	words = statement.split()
+	return not (' USING ' in step and 'LIMIT' in words and 'WHERE' not in words)
+
+@app.cli.command('explain-queries')
+@click.option('--user', 'username', help='Browse as this user (default: whoever has the most posts).')
+@click.option('--verbose', is_flag=True, help='Print every query plan, not just the failures.')
+def explain_queries(username, verbose):
+	"""Browse the main pages, EXPLAIN every SELECT they run and fail if any scans a whole table."""
+	if not is_sqlite(str(db.engine.url)):
+		raise click.ClickException('explain-queries reads SQLite query plans; run it against a SQLite copy of the data.')
+	me = User.query.filter_by(username=username).first() if username else \
+		User.query.order_by(User.posts_count.desc()).first()
+	if me is None:
+		raise click.ClickException('No such user.')
+	values = page_values(me)
+
+	statements, failed_pages = {}, 0
+	def capture(connection, cursor, statement, parameters, context, executemany):
+		if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+			statements.setdefault(statement, (parameters, page))
+	event.listen(db.engine, 'before_cursor_execute', capture)
+	try:
+		client = app.test_client()
+		with client.session_transaction() as session:
+			session.update(login_session(me))
+		for page in EXPLAIN_PAGES:
+			page = page.format(**values)
+			status = client.get(page).status_code
+			if status != 200:
+				click.echo('{} returned {}'.format(page, status))
+				failed_pages += 1
+	finally:
+		event.remove(db.engine, 'before_cursor_execute', capture)
+
+	failures = 0
+	with db.engine.connect() as connection:
+		for statement, (parameters, page) in statements.items():
+			plan = query_plan(connection, statement, parameters)
+			scans = [step for step in plan if is_full_scan(step, statement)]
+			if scans or verbose:
+				click.echo('{} {}\n  {}\n  {}'.format('FULL SCAN' if scans else 'ok', page,
+					' '.join(statement.split()), '\n  '.join(plan if verbose else scans)))
+			failures += bool(scans)
+	click.echo('{} queries explained, {} with a full table scan.'.format(len(statements), failures))
+	if failed_pages:
+		raise click.ClickException('{} page(s) did not return 200, so their queries were not checked'.format(
+			failed_pages))
+	if failures:
+		raise click.ClickException('add an index or rewrite the queries above')
+
+
+@app.cli.command('seed')
+@click.option('--users', default=200, type=click.IntRange(min=2))
+@click.option('--posts', default=2000, type=click.IntRange(min=0))
+@click.option('--follows', default=15, type=click.IntRange(min=0), help='Average people each user follows.')
+@click.option('--likes', default=10000, type=click.IntRange(min=0))
+@click.option('--comments', default=2000, type=click.IntRange(min=0))
+@click.option('--messages', default=3000, type=click.IntRange(min=0))
+@click.option('--days', default=180, type=click.IntRange(min=1), help='Spread activity over this many days.')
+@click.option('--seed', 'random_seed', default=1, help='The same seed generates the same data.')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def seed_command(users, posts, follows, likes, comments, messages, days, random_seed, yes):
+	"""Add synthetic users, follows, posts, likes, comments and messages for load testing. Every user's password is "password"."""
+	if not yes:
+		click.confirm('Add synthetic data to {!r}?'.format(db.engine.url), abort=True)
+	seed(users=users, posts=posts, follows=follows, likes=likes, comments=comments, messages=messages,
+		days=days, seed=random_seed, log=click.echo)
+
+
+@app.cli.command('bench')
+@click.option('--requests', default=50, type=click.IntRange(min=1), help='Timed requests per page.')
+@click.option('--warmup', default=5, type=click.IntRange(min=0), help='Untimed requests per page first.')
+@click.option('--user', 'username', help='Browse as this user (default: whoever follows the most people).')
+@click.option('--url', help='Benchmark a running server, e.g. http://127.0.0.1:8000, instead of the test client.')
+@click.option('--concurrency', default=1, type=click.IntRange(min=1), help='Parallel clients, with --url.')
+@click.option('--save', type=click.Path(dir_okay=False), help='Write the results to this JSON file, e.g. as a baseline.')
+@click.option('--compare', type=click.Path(exists=True, dir_okay=False), help='Fail on regressions against a saved run.')
+@click.option('--tolerance', default=0.25, help='Allowed p99 slowdown against --compare, as a fraction.')
+def bench(requests, warmup, username, url, concurrency, save, compare, tolerance):
+	"""Request the main pages repeatedly and report p50/p99 latency and queries per request."""
+	me = User.query.filter_by(username=username).first() if username else \
+		User.query.order_by(User.following_count.desc()).first()
+	if me is None:
+		raise click.ClickException('No such user.')
+	values = page_values(me)
+	driver = ServerDriver(url, me, concurrency) if url else TestClientDriver(me)
+	try:
+		results = run_benchmark(driver, values, requests=requests, warmup=warmup)
+	finally:
+		driver.close()
+	db.session.remove()
+
+	click.echo('{:<26} {:>6} {:>9} {:>9} {:>8}'.format('page', 'errors', 'p50 ms', 'p99 ms', 'queries'))
+	for page, result in results.items():
+		click.echo('{:<26} {:>6} {:>9} {:>9} {:>8}'.format(page, result['errors'], result['p50_ms'],
+			result['p99_ms'], '-' if result['queries'] is None else result['queries']))
+	errors = sum(result['errors'] for result in results.values())
+	if errors:
+		raise click.ClickException('{} request(s) did not return 200, so these timings are not of the pages'.format(errors))
+	if save:
+		save_results(save, results, url or 'test-client')
+		click.echo('Saved to {}.'.format(save))
+	if compare:
+		with open(compare) as f:
+			found = regressions(results, json.load(f), tolerance)
+		for regression in found:
+			click.echo('REGRESSION ' + regression)
+		if found:
+			raise click.ClickException('{} regression(s) against {}'.format(len(found), compare))
+		click.echo('No regressions against {}.'.format(compare))
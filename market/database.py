@@ -0,0 +1,61 @@
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# heroku style urls still say postgres://, which sqlalchemy 1.4+ rejects
+def database_uri(url):
+	if url.startswith('postgres://'):
+		url = 'postgresql://' + url[len('postgres://'):]
+	return url
+
+def is_sqlite(uri):
+	return make_url(uri).get_backend_name() == 'sqlite'
+
+# pool sizing for SQLALCHEMY_ENGINE_OPTIONS. each gunicorn worker has its own
+# pool, so the database sees up to workers * (pool_size + max_overflow) connections
+def engine_options(config):
+	uri = config['SQLALCHEMY_DATABASE_URI']
+	pool = {
+		'pool_size': config['DB_POOL_SIZE'],
+		'max_overflow': config['DB_MAX_OVERFLOW'],
+		'pool_timeout': config['DB_POOL_TIMEOUT'],
+	}
+	if is_sqlite(uri):
+		if make_url(uri).database in (None, '', ':memory:'):
+			return {}
+		#sqlite defaults to opening a new file handle per checkout; keep a few
+		#open instead. they move between threads, one at a time
+		return dict(pool, poolclass=QueuePool, connect_args={
+			'check_same_thread': False,
+			'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000.0,
+		})
+	options = dict(pool, pool_recycle=config['DB_POOL_RECYCLE'], pool_pre_ping=True)
+	if make_url(uri).get_backend_name() == 'postgresql' and config['DB_STATEMENT_TIMEOUT']:
+		options['connect_args'] = {'options': '-c statement_timeout={}'.format(config['DB_STATEMENT_TIMEOUT'])}
+	return options
+
+
+# per connection settings that sqlite does not remember in the file. WAL lets
+# readers carry on while one worker writes, synchronous=NORMAL is safe under
+# WAL, and busy_timeout makes a writer wait for the lock instead of failing
+# with "database is locked"
+def sqlite_pragmas(config):
+	return [
+		'PRAGMA journal_mode=WAL',
+		'PRAGMA synchronous=NORMAL',
+		'PRAGMA busy_timeout={}'.format(int(config['SQLITE_BUSY_TIMEOUT'])),
+		'PRAGMA mmap_size={}'.format(int(config['SQLITE_MMAP_SIZE'])),
+	]
+
+def configure_sqlite(app):
+	@event.listens_for(Engine, 'connect')
+	def set_sqlite_pragmas(dbapi_connection, connection_record):
+		if not isinstance(dbapi_connection, sqlite3.Connection):
+			return
+		cursor = dbapi_connection.cursor()
+		for pragma in sqlite_pragmas(app.config):
+			cursor.execute(pragma)
+		cursor.close()
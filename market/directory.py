@@ -0,0 +1,60 @@
+from collections import namedtuple
+from market import app, db
+from market.cache import TTLCache
+from market.models import User
+
+# the handful of user columns the templates render
+UserRecord = namedtuple('UserRecord', ['id', 'username', 'name', 'dp'])
+
+
+# cached lookups of compact user records, so no page has to load the
+# whole user table. stale entries age out after DIRECTORY_TTL seconds and
+# the cache is cleared whenever a user is created, updated or deleted.
+class UserDirectory(object):
+
+	def __init__(self, app):
+		self.cache = TTLCache(maxsize=app.config['DIRECTORY_MAX_ENTRIES'], ttl=app.config['DIRECTORY_TTL'])
+
+	def query(self):
+		return db.session.query(User.id, User.username, User.name, User.dp)
+
+	def get(self, user_id):
+		return self.get_many([user_id]).get(user_id)
+
+	def get_many(self, user_ids):
+		found, missing = {}, []
+		for user_id in user_ids:
+			record = self.cache.get(('id', user_id))
+			if record is None:
+				missing.append(user_id)
+			else:
+				found[user_id] = record
+		if missing:
+			for row in self.query().filter(User.id.in_(missing)):
+				record = UserRecord(*row)
+				self.cache.set(('id', record.id), record)
+				found[record.id] = record
+		return found
+
+	# usernames are stored lowercase and uniquely indexed. sqlite won't turn
+	# LIKE 'ab%' into a range on a case sensitive column, so the range
+	# ['ab', 'ac') is spelled out for the index; LIKE still checks the prefix
+	def search(self, prefix, limit=10):
+		prefix = prefix.lower().strip()
+		if not prefix:
+			return []
+		key = ('prefix', prefix, limit)
+		records = self.cache.get(key)
+		if records is None:
+			escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+			rows = self.query().filter(User.username >= prefix, User.username < prefix[:-1] + chr(ord(prefix[-1]) + 1),
+				User.username.like(escaped + '%', escape='\\')).order_by(User.username).limit(limit)
+			records = [UserRecord(*row) for row in rows]
+			self.cache.set(key, records)
+		return records
+
+	def invalidate(self):
+		self.cache.clear()
+
+
+directory = UserDirectory(app)
@@ -3,14 +3,34 @@ from flask_wtf.file import FileField, FileAllowed
 from flask_login import current_user
 from wtforms import StringField, PasswordField, SubmitField, BooleanField, TextAreaField, RadioField, DateField
 from flask_pagedown.fields import PageDownField
+from PIL import Image
+from werkzeug.datastructures import FileStorage
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError, Regexp
+from market import app
 from market.models import User
+from market.prices import parse_price
+
+# FileAllowed only looks at the extension. uploads are resized after the post
+# is saved (see market/images.py), so make sure the file decodes before that
+class ImageFile(object):
+	def __init__(self, message='That file is not an image we can read'):
+		self.message = message
+
+	def __call__(self, form, field):
+		if not (isinstance(field.data, FileStorage) and field.data):
+			return
+		try:
+			Image.open(field.data.stream).verify()
+		except Exception:
+			raise ValidationError(self.message)
+		finally:
+			field.data.stream.seek(0)
 
 class RegistrationForm(FlaskForm):
 	name = StringField('Contact', validators=[DataRequired()])
 	username = StringField('Username', validators = [DataRequired(), Length(min=2, max=20), Regexp(r'^[\w.-_.]+$', message='No Spaces. Use "-" or "_" or "." instead')]) 
 	email = StringField('Email', validators = [DataRequired(), Email()])
-	picture = FileField('Profile Picture', validators=[FileAllowed(['jpg', 'jpeg' , 'png'])])
+	picture = FileField('Profile Picture', validators=[FileAllowed(['jpg', 'jpeg' , 'png']), ImageFile()])
 	password = PasswordField('Password', validators = [DataRequired()])
 	confirm_password = PasswordField('Confirm Password', validators = [DataRequired(), EqualTo('password')])
 	submit = SubmitField('Sign Up')
@@ -38,6 +58,17 @@ class LoginForm(FlaskForm):
 	submit = SubmitField('Login')
 
 
+class RequestResetForm(FlaskForm):
+	email = StringField('Email', validators = [DataRequired(), Email()])
+	submit = SubmitField('Request Password Reset')
+
+
+class ResetPasswordForm(FlaskForm):
+	password = PasswordField('Password', validators = [DataRequired()])
+	confirm_password = PasswordField('Confirm Password', validators = [DataRequired(), EqualTo('password')])
+	submit = SubmitField('Reset Password')
+
+
 class CommentForm(FlaskForm):
 	body = StringField(('comment'), validators=[DataRequired(), Length(min=0, max=140)])
 	submit = SubmitField('🛫 Post')
@@ -46,26 +77,32 @@ class CommentForm(FlaskForm):
 class PostForm(FlaskForm):
 	title = StringField('Title') #validators=[DataRequired()]
 	content = PageDownField('Content', validators=[DataRequired()])
-	image = FileField('Product Image - Required', validators=[DataRequired(), FileAllowed(['jpg', 'jpeg' , 'png', 'gif'])])
-	image2 = FileField('Optional Image', validators=[FileAllowed(['jpg', 'jpeg' , 'png', 'gif'])])
-	image3 = FileField('Optional Image', validators=[FileAllowed(['jpg', 'jpeg' , 'png', 'gif'])])
-	price = StringField('Price', validators=[DataRequired()])
+	image = FileField('Product Image - Required', validators=[DataRequired(), FileAllowed(['jpg', 'jpeg' , 'png', 'gif']), ImageFile()])
+	image2 = FileField('Optional Image', validators=[FileAllowed(['jpg', 'jpeg' , 'png', 'gif']), ImageFile()])
+	image3 = FileField('Optional Image', validators=[FileAllowed(['jpg', 'jpeg' , 'png', 'gif']), ImageFile()])
+	price = StringField('Price', validators=[DataRequired(), Length(max=20)])
 	tags = StringField('enter #tags separated by spaces')
 	sold = BooleanField('Sold?')
 	submit = SubmitField('🛫 Post')
 
+	def validate_price(self, price):
+		try:
+			parse_price(price.data, app.config['DEFAULT_CURRENCY'])
+		except ValueError as e:
+			raise ValidationError(str(e))
+
 #no markdown support for posts from home
 class HomeForm(FlaskForm):
 	title = StringField('Title') #validators=[DataRequired()]
 	content = TextAreaField('Content', validators=[DataRequired()])
-	image = FileField('Upload Image', validators=[FileAllowed(['jpg', 'jpeg' , 'png', 'gif'])])
+	image = FileField('Upload Image', validators=[FileAllowed(['jpg', 'jpeg' , 'png', 'gif']), ImageFile()])
 	submit = SubmitField('🛫 Post')
 
 class UpdateAccountForm(FlaskForm):
 	name = StringField('Name', validators=[])
 	username = StringField('Username', validators = [DataRequired(), Length(min=2, max=20), Regexp(r'^[\w.-_.]+$')])
 	email = StringField('Email', validators = [Email(), DataRequired()])
-	picture = FileField('Profile Picture', validators=[FileAllowed(['jpg', 'jpeg' , 'png'])])
+	picture = FileField('Profile Picture', validators=[FileAllowed(['jpg', 'jpeg' , 'png']), ImageFile()])
 	location = StringField('Location', validators=[DataRequired()])
 	contact = StringField('Contact', validators=[])
 	bio = PageDownField('Bio')
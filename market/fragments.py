@@ -0,0 +1,105 @@
+import hashlib
+from markupsafe import Markup
+from market import app
+from market.cache import TTLCache
+
+
+# storage for rendered template fragments. every entry is saved with the
+# version it was rendered from and only served while that version still
+# matches, so a stale copy in another process is never shown
+class MemoryBackend(object):
+
+	def __init__(self, maxsize, ttl):
+		self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+	def get(self, key):
+		return self.cache.get(key)
+
+	def set(self, key, version, html):
+		self.cache.set(key, (version, html))
+
+	def delete(self, *keys):
+		for key in keys:
+			self.cache.delete(key)
+
+
+# shared by every worker process; needs the redis package
+class RedisBackend(object):
+
+	def __init__(self, url, ttl):
+		try:
+			import redis
+		except ImportError:
+			raise RuntimeError('FRAGMENT_CACHE={} needs the redis package installed'.format(url))
+		self.client = redis.Redis.from_url(url)
+		self.ttl = ttl
+
+	def get(self, key):
+		value = self.client.get(key)
+		if value is None:
+			return None
+		version, _, html = value.decode('utf-8').partition('\n')
+		return version, html
+
+	def set(self, key, version, html):
+		self.client.set(key, '{}\n{}'.format(version, html), ex=self.ttl)
+
+	def delete(self, *keys):
+		self.client.delete(*keys)
+
+
+class NullBackend(object):
+
+	def get(self, key):
+		return None
+
+	def set(self, key, version, html):
+		pass
+
+	def delete(self, *keys):
+		pass
+
+
+def create_backend(app):
+	setting = app.config['FRAGMENT_CACHE']
+	if setting == 'null':
+		return NullBackend()
+	if setting.startswith(('redis://', 'rediss://', 'unix://')):
+		return RedisBackend(setting, app.config['FRAGMENT_CACHE_TTL'])
+	return MemoryBackend(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+
+fragments = create_backend(app)
+
+
+def fragment_key(name, key, variant=''):
+	return 'fragment:{}:{}:{}'.format(name, key, variant)
+
+# {% call cached_fragment('post_card', post.id, post_card_version(post)) %}...{% endcall %}
+# renders the block once per version. anything that depends on the viewer
+# belongs outside the block, or in `variant` when it has only a few states
+@app.template_global()
+def cached_fragment(name, key, version, variant='', caller=None):
+	cache_key = fragment_key(name, key, variant)
+	version = str(version)
+	entry = fragments.get(cache_key)
+	if entry is not None and entry[0] == version:
+		return Markup(entry[1])
+	html = caller()
+	fragments.set(cache_key, version, str(html))
+	return Markup(html)
+
+
+POST_CARD_VARIANTS = ('own', 'other')
+
+def invalidate_post(post):
+	fragments.delete(*[fragment_key('post_card', post.id, variant) for variant in POST_CARD_VARIANTS])
+
+# a card changes when the seller edits the post, when its pictures are ready
+# and when the seller's name, picture or contact details change, which the
+# card shows too. likes and comments aren't on the card, so they don't count
+@app.template_global()
+def post_card_version(post):
+	author = post.author
+	seller = '\n'.join(str(value) for value in (author.name, author.username, author.dp, author.location, author.contact))
+	return '{}:{}{}:{}'.format(post.updated_at, int(bool(post.processing)), int(bool(post.image_failed)),
+		hashlib.sha1(seller.encode('utf-8')).hexdigest()[:12])
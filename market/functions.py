@@ -1,48 +1,16 @@
-import os
-from datetime import datetime
-import secrets
-from PIL import Image
-from market import app
+from market.images import stage_image
 
-# profile image resizing and optimization
-def profile_img(form_picture):
-	random_hex = secrets.token_hex(8)
-	_, f_ext = os.path.splitext(form_picture.filename)
-	picture_fn = random_hex + f_ext
-	picture_path = os.path.join(app.root_path, 'static/profile_pics', picture_fn)
-
-	output_size = (400,400)
-	i = Image.open(form_picture)
-	i.thumbnail(output_size)
-	i.save(picture_path)
+# uploads are only staged here; resizing and optimization run on the
+# background image queue (see market/images.py)
 
-	return picture_fn
+# profile image
+def profile_img(form_picture):
+	return stage_image(form_picture, 'profile_pics')
 
-# product image resizing and optimization
+# product image
 def market_img(form_picture):
-	random_hex = secrets.token_hex(8)
-	_, f_ext = os.path.splitext(form_picture.filename)
-	picture_fn = random_hex + f_ext
-	picture_path = os.path.join(app.root_path, 'static/market', picture_fn)
-
-	output_size = (400,400)
-	i = Image.open(form_picture)
-	i.thumbnail(output_size)
-	i.save(picture_path)
+	return stage_image(form_picture, 'market')
 
-	return picture_fn
-
-# post image resizing and optimization
+# post image
 def post_img(form_picture):
-	random_hex = secrets.token_hex(8)
-	_, f_ext = os.path.splitext(form_picture.filename)
-	picture_fn = random_hex + f_ext
-	picture_path = os.path.join(app.root_path, 'static/posts', picture_fn)
-
-	output_size = (400,400)
-	i = Image.open(form_picture)
-	i.thumbnail(output_size)
-	i.save(picture_path)
-
-	return picture_fn
-
+	return stage_image(form_picture, 'posts')
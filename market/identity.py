@@ -0,0 +1,177 @@
+import json
+import threading
+from datetime import datetime
+from flask_login import UserMixin
+from sqlalchemy.orm import object_session
+from market import app, db, login_manager
+from market.cache import TTLCache
+from market.models import User
+
+# the signed in user is rebuilt from a cached snapshot of a few columns
+# instead of a SELECT on every request. each entry carries the version it
+# was read under, and a commit that changes one of these columns (or the
+# password, or deletes the user) bumps the version, so an entry written by a
+# request that raced the change is never served. the in-process backend can
+# only bump versions in its own process, so with several workers either
+# keep IDENTITY_CACHE_TTL short or point IDENTITY_CACHE at a shared redis.
+SNAPSHOT_FIELDS = ('id', 'username', 'name', 'email', 'dp', 'bio', 'location', 'contact', 'last_seen')
+WATCHED_FIELDS = SNAPSHOT_FIELDS + ('password',)
+
+
+class MemoryBackend(object):
+
+	def __init__(self, maxsize, ttl):
+		self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+		#a bumped version outlives any entry a racing request wrote under the old one
+		self.versions = TTLCache(maxsize=maxsize, ttl=ttl * 2)
+		self.lock = threading.Lock()
+
+	def get(self, user_id):
+		return self.entries.get(user_id), self.versions.get(user_id, 0)
+
+	def set(self, user_id, entry):
+		self.entries.set(user_id, entry)
+
+	def bump(self, user_id):
+		with self.lock:
+			self.versions.set(user_id, self.versions.get(user_id, 0) + 1)
+		self.entries.delete(user_id)
+
+
+# shared by every worker process; needs the redis package
+class RedisBackend(object):
+
+	def __init__(self, url, ttl):
+		try:
+			import redis
+		except ImportError:
+			raise RuntimeError('IDENTITY_CACHE={} needs the redis package installed'.format(url))
+		self.client = redis.Redis.from_url(url)
+		self.ttl = ttl
+
+	def get(self, user_id):
+		entry, version = self.client.mget('identity:{}'.format(user_id), 'identity-version:{}'.format(user_id))
+		return json.loads(entry) if entry is not None else None, int(version or 0)
+
+	def set(self, user_id, entry):
+		self.client.set('identity:{}'.format(user_id), json.dumps(entry, default=str), ex=self.ttl)
+
+	def bump(self, user_id):
+		key = 'identity-version:{}'.format(user_id)
+		pipeline = self.client.pipeline()
+		pipeline.incr(key)
+		pipeline.expire(key, self.ttl * 2)
+		pipeline.delete('identity:{}'.format(user_id))
+		pipeline.execute()
+
+
+class NullBackend(object):
+
+	def get(self, user_id):
+		return None, 0
+
+	def set(self, user_id, entry):
+		pass
+
+	def bump(self, user_id):
+		pass
+
+
+def create_backend(app):
+	setting = app.config['IDENTITY_CACHE']
+	if setting == 'null':
+		return NullBackend()
+	if setting.startswith(('redis://', 'rediss://', 'unix://')):
+		return RedisBackend(setting, app.config['IDENTITY_CACHE_TTL'])
+	return MemoryBackend(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL'])
+
+identities = create_backend(app)
+
+
+# current_user for a request: read-only, with the queries that only need the
+# user's id. routes that change the user go through `model`
+class SessionUser(UserMixin):
+
+	def __init__(self, entry):
+		for field in SNAPSHOT_FIELDS:
+			object.__setattr__(self, field, entry[field])
+		object.__setattr__(self, '_model', None)
+
+	def __setattr__(self, name, value):
+		raise AttributeError('current_user is a cached snapshot; change current_user.model instead')
+
+	# the full User row, loaded on first use in this request
+	@property
+	def model(self):
+		if self._model is None:
+			object.__setattr__(self, '_model', User.query.get(self.id))
+		return self._model
+
+	def __eq__(self, other):
+		return isinstance(other, (User, SessionUser)) and other.id == self.id
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash(self.id)
+
+	def __repr__(self):
+		return '<SessionUser {}>'.format(self.username)
+
+	followed_posts = User.followed_posts
+	following_ids = User.following_ids
+	follower_ids = User.follower_ids
+	mutual_follow_ids = User.mutual_follow_ids
+	has_liked_post = User.has_liked_post
+	liked_post_ids = User.liked_post_ids
+	like_post = User.like_post
+	unlike_post = User.unlike_post
+	new_messages = User.new_messages
+
+
+def snapshot(user, version):
+	entry = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+	entry['version'] = version
+	return entry
+
+@login_manager.user_loader
+def load_user(user_id):
+	user_id = int(user_id)
+	entry, version = identities.get(user_id)
+	if entry is None or entry['version'] != version:
+		user = User.query.get(user_id)
+		if user is None:
+			return None
+		entry = snapshot(user, version)
+		identities.set(user_id, entry)
+	elif isinstance(entry['last_seen'], str):
+		entry = dict(entry, last_seen=datetime.fromisoformat(entry['last_seen']))
+	return SessionUser(entry)
+
+
+# versions are bumped once the change is committed, so a request that reads
+# the row in between can only cache it under the old version
+def _changed(target):
+	session = object_session(target)
+	if session is not None:
+		session.info.setdefault('identity_changed', set()).add(target.id)
+
+@db.event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, target):
+	state = db.inspect(target)
+	if any(state.attrs[field].history.has_changes() for field in WATCHED_FIELDS):
+		_changed(target)
+
+@db.event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, target):
+	_changed(target)
+
+@db.event.listens_for(db.session, 'after_commit')
+def bump_versions(session):
+	for user_id in session.info.pop('identity_changed', ()):
+		identities.bump(user_id)
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_changes(session):
+	session.info.pop('identity_changed', None)
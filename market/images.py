@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from flask import url_for, request
+from PIL import Image, ImageOps
+from market import app, db
+from market.cache import TTLCache
+from market.directory import directory
+from market.models import User, Post, StoredImage
+from market.tasks import TaskQueue, off_hub
+
+image_queue = TaskQueue(app, 'images', app.config['IMAGE_WORKERS'], app.config['IMAGE_QUEUE_DEPTH'])
+
+
+def staging_path(folder, picture_fn):
+	staging = app.config['UPLOAD_STAGING_DIR']
+	os.makedirs(staging, exist_ok=True)
+	return os.path.join(staging, folder + '-' + os.path.basename(picture_fn))
+
+# uploads are stored by content hash, sharded two levels deep (ab/cd/abcd....jpg),
+# so the same photo uploaded twice is stored and processed once, and a url
+# never changes meaning. every variant is re-encoded, so the name is always a jpeg
+def content_name(data):
+	digest = hashlib.sha256(data).hexdigest()[:32]
+	return '{}/{}/{}.jpg'.format(digest[:2], digest[2:4], digest)
+
+# save the raw upload and pick its final name; resizing happens in the background
+def stage_image(form_picture, folder):
+	data = form_picture.read()
+	picture_fn = content_name(data)
+	if not os.path.exists(manifest_path(folder, picture_fn)):
+		with open(staging_path(folder, picture_fn), 'wb') as f:
+			f.write(data)
+	return picture_fn
+
+# widths generated per folder; the first one is also saved under the plain
+# filename as the fallback for old browsers and anything without a manifest
+VARIANTS = {
+	'posts': (400, 800, 1600), #feed card, detail page, retina detail
+	'profile_pics': (150, 400),
+	'market': (400, 800, 1600),
+}
+
+def manifest_path(folder, picture_fn):
+	return os.path.join(app.root_path, 'static', folder, os.path.splitext(picture_fn)[0] + '.json')
+
+# exif orientation is applied and all metadata dropped; transparency is
+# flattened onto white for jpeg and kept for webp
+def _encode(image, path_stem):
+	if image.mode not in ('RGB', 'RGBA'):
+		image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'P') else 'RGB')
+	image.save(path_stem + '.webp', 'WEBP', quality=80, method=6)
+	if image.mode == 'RGBA':
+		flat = Image.new('RGB', image.size, (255, 255, 255))
+		flat.paste(image, mask=image.split()[-1])
+		image = flat
+	image.save(path_stem + '.jpg', 'JPEG', quality=82, optimize=True, progressive=True)
+
+# resize a staged upload into its variants in static/<folder> plus a json manifest
+def process_image(folder, picture_fn):
+	staged = staging_path(folder, picture_fn)
+	#claim the upload; the same content may have been queued twice
+	working = '{}.{}'.format(staged, threading.get_ident())
+	try:
+		os.rename(staged, working)
+	except FileNotFoundError:
+		return
+	try:
+		off_hub(_write_variants, folder, picture_fn, working)
+	finally:
+		os.remove(working)
+
+def _write_variants(folder, picture_fn, staged):
+	stem = os.path.splitext(picture_fn)[0]
+	target = os.path.join(app.root_path, 'static', folder)
+	os.makedirs(os.path.dirname(os.path.join(target, picture_fn)), exist_ok=True)
+	source = ImageOps.exif_transpose(Image.open(staged))
+	manifest = {'width': source.width, 'height': source.height, 'variants': []}
+	widths = VARIANTS[folder]
+	for width in widths:
+		#never upscale; the smallest variant is always produced
+		if width > max(source.size) and width != widths[0]:
+			break
+		variant = source.copy()
+		variant.thumbnail((width, width), Image.LANCZOS)
+		name = '{}_{}'.format(stem, width)
+		_encode(variant, os.path.join(target, name))
+		manifest['variants'].append({'width': variant.width, 'height': variant.height,
+			'jpeg': name + '.jpg', 'webp': name + '.webp'})
+	shutil.copyfile(os.path.join(target, manifest['variants'][0]['jpeg']), os.path.join(target, picture_fn))
+	with open(manifest_path(folder, picture_fn), 'w') as f:
+		json.dump(manifest, f)
+
+
+manifests = TTLCache(maxsize=4096, ttl=3600)
+
+def image_manifest(folder, picture_fn):
+	key = (folder, picture_fn)
+	manifest = manifests.get(key)
+	if manifest is None:
+		try:
+			with open(manifest_path(folder, picture_fn)) as f:
+				manifest = json.load(f)
+		except (IOError, ValueError):
+			return None
+		manifests.set(key, manifest)
+	return manifest
+
+# "url 400w, url 800w" for an <img>/<source> srcset, or '' for images
+# uploaded before variants existed
+@app.template_global()
+def srcset(folder, picture_fn, fmt='jpeg'):
+	manifest = image_manifest(folder, picture_fn) if picture_fn else None
+	if not manifest:
+		return ''
+	return ', '.join('{} {}w'.format(url_for('static', filename=folder + '/' + variant[fmt]), variant['width'])
+		for variant in manifest['variants'])
+
+
+# a picture that can't be resized leaves the post marked as failed rather
+# than pointing at files that were never written
+def _process_post_images(post_id, filenames):
+	post = Post.__table__
+	try:
+		for picture_fn in filenames:
+			process_image('posts', picture_fn)
+	except Exception:
+		db.session.rollback()
+		db.session.execute(post.update().where(post.c.id == post_id).values(image_failed=True))
+		db.session.commit()
+		raise
+	db.session.execute(post.update().where(post.c.id == post_id).values(processing=False, image_failed=False))
+	db.session.commit()
+
+def _process_profile_image(user_id, picture_fn):
+	process_image('profile_pics', picture_fn)
+	user = User.query.get(user_id)
+	if user:
+		user.dp = picture_fn
+		db.session.commit()
+		#the directory caches dp too; the account commit came before this one
+		directory.invalidate()
+
+# call after the post is committed; it stays "processing" until every image is ready
+def process_post_images(post, *filenames):
+	image_queue.submit_or_run(_process_post_images, post.id, [fn for fn in filenames if fn])
+
+# the new picture replaces user.dp once it has been resized
+def process_profile_image(user, picture_fn):
+	image_queue.submit_or_run(_process_profile_image, user.id, picture_fn)
+
+
+# reference counts for stored images, kept in the same flush as the rows that
+# point at them. files whose count drops to zero are removed by `flask gc-images`
+IMAGE_COLUMNS = {Post: ('posts', ('image', 'image2', 'image3')), User: ('profile_pics', ('dp',))}
+
+def _adjust_refcount(connection, folder, picture_fn, delta):
+	stored = StoredImage.__table__
+	updated = connection.execute(stored.update().where(db.and_(
+		stored.c.folder == folder, stored.c.filename == picture_fn)).values(refcount=stored.c.refcount + delta))
+	if not updated.rowcount and delta > 0:
+		connection.execute(stored.insert().values(folder=folder, filename=picture_fn, refcount=delta))
+
+def _image_refs_changed(mapper, connection, target, added, removed):
+	folder, _ = IMAGE_COLUMNS[mapper.class_]
+	for picture_fn in added:
+		_adjust_refcount(connection, folder, picture_fn, 1)
+	for picture_fn in removed:
+		_adjust_refcount(connection, folder, picture_fn, -1)
+
+def _track_images(model):
+	_, columns = IMAGE_COLUMNS[model]
+
+	@db.event.listens_for(model, 'after_insert')
+	def inserted(mapper, connection, target):
+		current = [getattr(target, column) for column in columns]
+		_image_refs_changed(mapper, connection, target, [fn for fn in current if fn], [])
+
+	@db.event.listens_for(model, 'after_update')
+	def updated(mapper, connection, target):
+		added, removed = [], []
+		for column in columns:
+			history = db.inspect(target).attrs[column].history
+			if history.has_changes():
+				added += [fn for fn in history.added if fn]
+				removed += [fn for fn in history.deleted if fn]
+		_image_refs_changed(mapper, connection, target, added, removed)
+
+	@db.event.listens_for(model, 'after_delete')
+	def deleted(mapper, connection, target):
+		current = [getattr(target, column) for column in columns]
+		_image_refs_changed(mapper, connection, target, [], [fn for fn in current if fn])
+
+_track_images(Post)
+_track_images(User)
+
+
+IMAGE_FOLDERS = ('posts', 'profile_pics')
+
+# files that belong to one stored image: the image, its variants and manifest
+def image_files(folder, picture_fn):
+	stem = os.path.join(app.root_path, 'static', folder, os.path.splitext(picture_fn)[0])
+	directory, base = os.path.split(stem)
+	if not os.path.isdir(directory):
+		return []
+	pattern = re.compile(r'^{}(_\d+)?\.(jpg|jpeg|png|gif|webp|json)$'.format(re.escape(base)))
+	return [os.path.join(directory, name) for name in os.listdir(directory) if pattern.match(name)]
+
+def remove_image(folder, picture_fn):
+	for path in image_files(folder, picture_fn):
+		os.remove(path)
+	manifests.delete((folder, picture_fn))
+
+# delete files that nothing references any more. files younger than `grace`
+# seconds are left alone, since their row may not be committed yet
+def collect_garbage(grace=3600, dry_run=False):
+	removed = []
+	protected = {('profile_pics', 'default.png')}
+	for folder in IMAGE_FOLDERS:
+		referenced = {filename for filename, in db.session.query(StoredImage.filename).filter(
+			StoredImage.folder == folder, StoredImage.refcount > 0)}
+		referenced_stems = {os.path.splitext(filename)[0] for filename in referenced}
+		root = os.path.join(app.root_path, 'static', folder)
+		for directory, _, names in os.walk(root):
+			for name in names:
+				path = os.path.join(directory, name)
+				relative = os.path.relpath(path, root).replace(os.sep, '/')
+				stem = re.sub(r'(_\d+)?\.\w+$', '', relative)
+				if stem in referenced_stems or (folder, relative) in protected or name.startswith('.'):
+					continue
+				if time.time() - os.path.getmtime(path) < grace:
+					continue
+				removed.append(path)
+				if not dry_run:
+					os.remove(path)
+	if not dry_run:
+		StoredImage.query.filter(StoredImage.refcount <= 0).delete(synchronize_session=False)
+		db.session.commit()
+	return removed
+
+
+# content addressed urls never change meaning, so browsers may keep them forever
+CONTENT_ADDRESSED = re.compile(r'^(posts|profile_pics)/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{32}')
+
+@app.after_request
+def cache_stored_images(response):
+	if request.endpoint == 'static' and response.status_code == 200 \
+			and CONTENT_ADDRESSED.match(request.view_args.get('filename', '')):
+		response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+	return response
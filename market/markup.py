@@ -0,0 +1,45 @@
+import threading
+import bleach
+from bleach.linkifier import LinkifyFilter
+from markdown import Markdown
+
+# tags kept by the sanitizer, per kind of text. changing a list means the
+# stored html is stale: run `flask rerender-markdown` afterwards
+ALLOWED_TAGS = {
+	'bio': ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+		'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+		'h3', 'p', 'iframe'],
+	'body': ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
+		'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
+		'h1', 'h2', 'h3', 'p', 'iframe'],
+}
+
+
+# building a Markdown or Cleaner instance is far more expensive than using
+# one, so they are made once and reused. neither is safe to use from two
+# renders at once, so each render borrows a pair from a pool and gives it
+# back; the pool only grows to the number of renders running at the same time.
+# (keyed by thread it churned under eventlet, where every request is a new
+# green thread)
+pool = {policy: [] for policy in ALLOWED_TAGS}
+pool_lock = threading.Lock()
+
+def pipeline(policy):
+	cleaner = bleach.Cleaner(tags=ALLOWED_TAGS[policy], strip=True, filters=[LinkifyFilter])
+	return Markdown(output_format='html'), cleaner
+
+def render_markdown(text, policy='body'):
+	if not text:
+		return ''
+	with pool_lock:
+		pair = pool[policy].pop() if pool[policy] else None
+	md, cleaner = pair or pipeline(policy)
+	try:
+		html = cleaner.clean(md.reset().convert(text))
+	finally:
+		with pool_lock:
+			pool[policy].append((md, cleaner))
+	#a single paragraph is unwrapped so it can sit inline next to other text
+	if html.startswith('<p>') and html.endswith('</p>') and html.count('<p>') == 1:
+		html = html[3:-4]
+	return html
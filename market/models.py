@@ -1,20 +1,43 @@
+import re
 from datetime import datetime
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from market import db, login_manager, app
+from market import db, app
 from flask_login import UserMixin
-from markdown import markdown
-import bleach
+from market.markup import render_markdown
+from market.prices import parse_price
 
 
 
-@login_manager.user_loader
-def load_user(user_id):
-	return User.query.get(int(user_id))
-
 followers = db.Table(
 	'followers',
 	db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-	db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+	db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+	db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True),
+	db.Index('ix_followers_followed_id_follower_id', 'followed_id', 'follower_id')
+)
+
+# which posts carry which tag. date_posted is copied from the post so a tag
+# page and the trending window are both range scans over this table alone
+post_tag = db.Table(
+	'post_tag',
+	db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False),
+	db.Column('tag_id', db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False),
+	db.Column('date_posted', db.DateTime, nullable=False),
+	db.Index('ix_post_tag_post_id_tag_id', 'post_id', 'tag_id', unique=True),
+	db.Index('ix_post_tag_tag_id_date_posted', 'tag_id', 'date_posted', 'post_id'),
+	db.Index('ix_post_tag_date_posted_tag_id', 'date_posted', 'tag_id')
+)
+
+# each user's following feed, written when a post is created (see
+# market/timeline.py) so reading it is one range scan on this index
+timeline = db.Table(
+	'timeline',
+	db.Column('user_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
+	db.Column('post_id', db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), nullable=False),
+	db.Column('author_id', db.Integer, db.ForeignKey('user.id'), nullable=False),
+	db.Column('date_posted', db.DateTime, nullable=False),
+	db.Index('ix_timeline_user_id_date_posted_post_id', 'user_id', 'date_posted', 'post_id', unique=True),
+	db.Index('ix_timeline_post_id', 'post_id')
 )
 
 liked = db.relationship(
@@ -28,7 +51,8 @@ class User(db.Model, UserMixin):
 	username = db.Column(db.String(20), unique=True, nullable=False)
 	email = db.Column(db.String(120), unique=True, nullable=False)
 	bio = db.Column(db.String(120), nullable=True)
-	dp = db.Column(db.String(20), nullable=False, default='default.png')
+	bio_html = db.Column(db.Text, nullable=True)
+	dp = db.Column(db.String(64), nullable=False, default='default.png')
 	location = db.Column(db.String(50), nullable=True)
 	contact = db.Column(db.String(50), nullable=True)
 	password = db.Column(db.String(60), nullable=False)
@@ -48,6 +72,9 @@ class User(db.Model, UserMixin):
 										foreign_keys='Message.recipient_id',
 										backref='recipient', lazy='dynamic')
 	last_message_read_time = db.Column(db.DateTime)
+	followers_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	posts_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 
 	def get_reset_token(self, expires_sec=1800):
@@ -68,67 +95,138 @@ class User(db.Model, UserMixin):
 	def __repr__(self):
 		return f"User('{self.username}' , '{self.email}', '{self.image_file}')"
 
+	# counters are bumped with SQL expressions so concurrent writers can't lose updates
 	def follow(self, user):
 		if not self.is_following(user):
 			self.followed.append(user)
+			self.following_count = User.following_count + 1
+			user.followers_count = User.followers_count + 1
 
 	def unfollow(self, user):
 		if self.is_following(user):
 			self.followed.remove(user)
+			self.following_count = User.following_count - 1
+			user.followers_count = User.followers_count - 1
 
 	def is_following(self, user):
 		return self.followed.filter(followers.c.followed_id == user.id).count() > 0
 
+	# which of the given users this user follows, in one query
+	def following_ids(self, user_ids):
+		if not user_ids:
+			return set()
+		rows = db.session.query(followers.c.followed_id).filter(
+			followers.c.follower_id == self.id,
+			followers.c.followed_id.in_(user_ids))
+		return {user_id for user_id, in rows}
+
+	# which of the given users follow this user, in one query
+	def follower_ids(self, user_ids):
+		if not user_ids:
+			return set()
+		rows = db.session.query(followers.c.follower_id).filter(
+			followers.c.followed_id == self.id,
+			followers.c.follower_id.in_(user_ids))
+		return {user_id for user_id, in rows}
+
+	# ids of the people this user follows who follow them back
+	def mutual_follow_ids(self):
+		following = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id)
+		rows = db.session.query(followers.c.follower_id).filter(
+			followers.c.followed_id == self.id,
+			followers.c.follower_id.in_(following))
+		return [user_id for user_id, in rows]
+
+	# built on read; market/timeline.py serves the same feed precomputed
 	def followed_posts(self):
-		followed = Post.query.join(
-			followers, (followers.c.followed_id == Post.user_id)).filter(
-				followers.c.follower_id == self.id)
-		own = Post.query.filter_by(user_id=self.id)
-		return followed.union(own).order_by(Post.date_posted.desc())
+		followed = db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id)
+		return Post.query.filter(db.or_(Post.user_id.in_(followed), Post.user_id == self.id)).order_by(
+			Post.date_posted.desc())
 
 	def like_post(self, post):
 		if not self.has_liked_post(post):
 			like = PostLike(user_id=self.id, post_id=post.id)
 			db.session.add(like)
+			post.likes_count = Post.likes_count + 1
+			return True
+		return False
 
 	def unlike_post(self, post):
-		if self.has_liked_post(post):
-			PostLike.query.filter_by(
-				user_id=self.id,
-				post_id=post.id).delete()
+		removed = PostLike.query.filter_by(
+			user_id=self.id,
+			post_id=post.id).delete()
+		if removed:
+			post.likes_count = Post.likes_count - removed
 
 	def has_liked_post(self, post):
 		return PostLike.query.filter(
 			PostLike.user_id == self.id,
 			PostLike.post_id == post.id).count() > 0
 
+	# like state for a whole page of posts in one query, for rendering feeds
+	def liked_post_ids(self, posts):
+		post_ids = [post.id for post in posts]
+		if not post_ids:
+			return set()
+		rows = db.session.query(PostLike.post_id).filter(
+			PostLike.user_id == self.id,
+			PostLike.post_id.in_(post_ids))
+		return {post_id for post_id, in rows}
+
+	# sellers whose posts this user liked, most liked first, minus anyone
+	# the viewer already follows
+	def liked_authors(self, viewer, limit=20):
+		already_followed = db.session.query(followers.c.followed_id).filter(
+			followers.c.follower_id == viewer.id)
+		return User.query.join(Post, Post.user_id == User.id).join(
+			PostLike, PostLike.post_id == Post.id).filter(
+				PostLike.user_id == self.id,
+				User.id != viewer.id,
+				~User.id.in_(already_followed)).group_by(User.id).order_by(
+					db.func.count(PostLike.id).desc()).limit(limit).all()
+
+	# unread messages across all of this user's conversations
 	def new_messages(self):
-		last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-		return Message.query.filter_by(recipient=self).filter(
-			Message.timestamp > last_read_time).count()
+		unread = db.session.query(db.func.sum(db.case(
+			[(Conversation.user_a_id == self.id, Conversation.unread_a)],
+			else_=Conversation.unread_b))).filter(Conversation.involving(self.id)).scalar()
+		return unread or 0
 
 	@staticmethod
 	def on_changed_body(target, value, oldvalue, initiator):
-		allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-		'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-		'h3', 'p', 'iframe']
-		target.content = bleach.linkify(bleach.clean(markdown(value, output_format='html'),
-			tags=allowed_tags, strip=True))
+		target.bio_html = render_markdown(value, 'bio')
 
 class Post(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	title = db.Column(db.String(100), nullable=True)
 	content = db.Column(db.Text, nullable=False)
-	image = db.Column(db.String(20), nullable=False)
-	image2 = db.Column(db.String(20), nullable=True)
-	image3 = db.Column(db.String(20), nullable=True)
+	content_html = db.Column(db.Text, nullable=True)
+	image = db.Column(db.String(64), nullable=False)
+	image2 = db.Column(db.String(64), nullable=True)
+	image3 = db.Column(db.String(64), nullable=True)
 	price = db.Column(db.String(20), nullable=False)
+	price_amount = db.Column(db.BigInteger, nullable=True) #minor units, e.g. cents; null if the text was unreadable
+	price_currency = db.Column(db.String(3), nullable=True)
 	tags = db.Column(db.String(100), nullable=True)
 	date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+	updated_at = db.Column(db.DateTime, default=datetime.utcnow) #set when the seller edits the post, not by counter updates
 	sold = db.Column(db.Boolean, default=False, nullable=False)
+	processing = db.Column(db.Boolean, default=False, nullable=False, server_default=db.false())
+	image_failed = db.Column(db.Boolean, default=False, nullable=False, server_default=db.false()) #the image job gave up; re-upload
 	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-	likes = db.relationship('PostLike', backref='post', lazy='dynamic')
-	comments = db.relationship("Comment", backref="post", lazy="dynamic", cascade="all, delete-orphan")
+	likes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	comments_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	#deleting a post leaves its likes and comments to the database (postgres)
+	#or to the purge job (see market/purge.py) instead of loading each one
+	likes = db.relationship('PostLike', backref='post', lazy='dynamic', passive_deletes=True)
+	comments = db.relationship("Comment", backref="post", lazy="dynamic", cascade="all, delete-orphan", passive_deletes=True)
+	__table_args__ = (
+		db.Index('ix_post_date_posted_id', 'date_posted', 'id'),
+		db.Index('ix_post_user_id_date_posted_id', 'user_id', 'date_posted', 'id'),
+		#unsold items in one currency, by price, are one range scan
+		db.Index('ix_post_sold_price_currency_price_amount_date_posted_id',
+			'sold', 'price_currency', 'price_amount', 'date_posted', 'id'),
+	)
 
 	
 	def __repr__(self):
@@ -137,36 +235,78 @@ class Post(db.Model):
 		else:
 			return f"Post({self.content}', '{self.date_posted}')"
 
+	# whatever the seller typed is stored as "#one #two"; post_tag follows it
+	@db.validates('tags')
+	def normalize_tags(self, key, value):
+		tags = ''
+		for name in Tag.parse(value):
+			if len(tags) + len(name) + 2 > 100:
+				break
+			tags = (tags + ' #' + name).lstrip()
+		return tags or None
+
+	# the amount and currency are read from the text as typed, which is kept
+	# for display; text that can't be read is refused
+	@db.validates('price')
+	def normalize_price(self, key, value):
+		self.price_amount, self.price_currency = parse_price(value, app.config['DEFAULT_CURRENCY'])
+		return value.strip()
+
+	@property
+	def tag_names(self):
+		return Tag.parse(self.tags)
+
 	@staticmethod
 	def on_changed_body(target, value, oldvalue, initiator):
-		allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-		'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-		'h1', 'h2', 'h3', 'p', 'iframe']
-		target.content = bleach.linkify(bleach.clean(markdown(value, output_format='html'),
-			tags=allowed_tags, strip=True))
+		target.content_html = render_markdown(value)
 
 
 
+class Tag(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	name = db.Column(db.String(50), nullable=False, unique=True)
+
+	MAX_PER_POST = 10
+
+	# "#Moncler #winter, moncler" -> ['moncler', 'winter']
+	@staticmethod
+	def parse(text):
+		names = []
+		for name in re.findall(r'\w+', (text or '').lower()):
+			name = name[:50] #as stored, so two long tags that share 50 characters are one tag
+			if name not in names:
+				names.append(name)
+		return names[:Tag.MAX_PER_POST]
+
+	def __repr__(self):
+		return '<Tag {}>'.format(self.name)
+
+
 class PostLike(db.Model):
 	__tablename__ = 'post_like'
+	__table_args__ = (
+		db.Index('ix_post_like_user_id_post_id', 'user_id', 'post_id', unique=True),
+		db.Index('ix_post_like_post_id', 'post_id'),
+	)
 	id = db.Column(db.Integer, primary_key=True)
 	user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-	post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+	post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'))
 
 class Comment(db.Model):
 	id = db.Column(db.Integer, primary_key=True)
 	body = db.Column(db.Text, nullable=False)
+	body_html = db.Column(db.Text, nullable=True)
 	date_posted = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 	user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-	post_id = db.Column(db.Integer, db.ForeignKey("post.id"), nullable=False)
+	post_id = db.Column(db.Integer, db.ForeignKey("post.id", ondelete='CASCADE'), nullable=False)
+	__table_args__ = (
+		db.Index('ix_comment_post_id_date_posted', 'post_id', 'date_posted'),
+		db.Index('ix_comment_user_id', 'user_id'),
+	)
 
 	@staticmethod
 	def on_changed_body(target, value, oldvalue, initiator):
-		allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-		'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-		'h1', 'h2', 'h3', 'p', 'iframe']
-		target.body = bleach.linkify(bleach.clean(markdown(value, output_format='html'),
-			tags=allowed_tags, strip=True))
+		target.body_html = render_markdown(value)
 
 	def __repr__(self):
 		return f"<Reply (id='{self.id}', body='{self.body}', date_posted='{self.date_posted}')>"
@@ -177,16 +317,231 @@ class Message(db.Model):
 	sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 	recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 	body = db.Column(db.Text) #db.String(140)
+	body_html = db.Column(db.Text)
 	timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+	#a thread is read from both sides, so one index per direction
+	__table_args__ = (
+		db.Index('ix_message_sender_id_recipient_id_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+		db.Index('ix_message_recipient_id_sender_id_timestamp', 'recipient_id', 'sender_id', 'timestamp'),
+	)
 
 	@staticmethod
 	def on_changed_body(target, value, oldvalue, initiator):
-		allowed_tags = ['a', 'abbr', 'acronym', 'b', 'blockquote', 'code',
-		'em', 'i', 'li', 'ol', 'pre', 'strong', 'ul',
-		'h1', 'h2', 'h3', 'p', 'iframe']
-		target.body = bleach.linkify(bleach.clean(markdown(value, output_format='html'),
-			tags=allowed_tags, strip=True))
+		target.body_html = render_markdown(value)
 
 	def __repr__(self):
 		return '<Message {}>'.format(self.body)
 
+
+# how many rows point at each stored upload (see market/images.py)
+class StoredImage(db.Model):
+	__tablename__ = 'stored_image'
+	id = db.Column(db.Integer, primary_key=True)
+	folder = db.Column(db.String(20), nullable=False)
+	filename = db.Column(db.String(64), nullable=False)
+	refcount = db.Column(db.Integer, nullable=False, default=0)
+	created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+	__table_args__ = (db.Index('ix_stored_image_folder_filename', 'folder', 'filename', unique=True),)
+
+	def __repr__(self):
+		return '<StoredImage {}/{} x{}>'.format(self.folder, self.filename, self.refcount)
+
+
+# one row per pair of users, kept up to date as messages are written, so the
+# inbox is a single indexed query instead of a walk over every message.
+# user_a is always the lower of the two ids.
+class Conversation(db.Model):
+	id = db.Column(db.Integer, primary_key=True)
+	user_a_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+	user_b_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+	last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+	last_timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+	unread_a = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	unread_b = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+	user_a = db.relationship('User', foreign_keys=[user_a_id])
+	user_b = db.relationship('User', foreign_keys=[user_b_id])
+	last_message = db.relationship('Message')
+	__table_args__ = (
+		db.Index('ix_conversation_user_a_id_user_b_id', 'user_a_id', 'user_b_id', unique=True),
+		db.Index('ix_conversation_user_a_id_last_timestamp', 'user_a_id', 'last_timestamp'),
+		db.Index('ix_conversation_user_b_id_last_timestamp', 'user_b_id', 'last_timestamp'),
+	)
+
+	@staticmethod
+	def pair(user_id, other_id):
+		return min(user_id, other_id), max(user_id, other_id)
+
+	@staticmethod
+	def involving(user_id):
+		return db.or_(Conversation.user_a_id == user_id, Conversation.user_b_id == user_id)
+
+	@staticmethod
+	def between(user, other):
+		user_a_id, user_b_id = Conversation.pair(user.id, other.id)
+		return Conversation.query.filter_by(user_a_id=user_a_id, user_b_id=user_b_id).first()
+
+	@staticmethod
+	def inbox(user, limit=50):
+		return Conversation.query.filter(Conversation.involving(user.id)).options(
+			db.joinedload(Conversation.user_a), db.joinedload(Conversation.user_b),
+			db.joinedload(Conversation.last_message)).order_by(
+				Conversation.last_timestamp.desc()).limit(limit).all()
+
+	def other(self, user):
+		return self.user_b if self.user_a_id == user.id else self.user_a
+
+	def unread_for(self, user):
+		return self.unread_a if self.user_a_id == user.id else self.unread_b
+
+	def mark_read(self, user):
+		if self.user_a_id == user.id:
+			self.unread_a = 0
+		else:
+			self.unread_b = 0
+
+	def __repr__(self):
+		return '<Conversation {} {}>'.format(self.user_a_id, self.user_b_id)
+
+
+# an email waiting to go out (see market/outbox.py). rows are written in the
+# same transaction as whatever caused them and deleted once sent; a message
+# that keeps failing stays behind as 'failed'. a claimed ('sending') row's
+# next_attempt_at is pushed past the claim timeout, so one a crashed worker
+# held becomes due again by itself
+class OutboxMessage(db.Model):
+	__tablename__ = 'outbox_message'
+	id = db.Column(db.Integer, primary_key=True)
+	sender = db.Column(db.String(120))
+	recipients = db.Column(db.Text, nullable=False) #comma separated
+	subject = db.Column(db.String(200), nullable=False)
+	body = db.Column(db.Text, nullable=False)
+	html = db.Column(db.Text)
+	status = db.Column(db.String(10), nullable=False, default='pending') #pending, sending or failed
+	attempts = db.Column(db.Integer, nullable=False, default=0)
+	next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+	claim = db.Column(db.String(32))
+	last_error = db.Column(db.Text)
+	created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+	__table_args__ = (db.Index('ix_outbox_message_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+	def __repr__(self):
+		return '<OutboxMessage {} to {} {}>'.format(self.id, self.recipients, self.status)
+
+
+# deleting an account or a post in the background, in small batches (see
+# market/purge.py). `deleted` counts rows removed so far out of roughly
+# `total`, counted when the job started; `images` lists the uploads it let
+# go of, as "folder/filename", so their files can be removed at the end
+class PurgeJob(db.Model):
+	__tablename__ = 'purge_job'
+	id = db.Column(db.Integer, primary_key=True)
+	kind = db.Column(db.String(10), nullable=False) #user or post
+	target_id = db.Column(db.Integer, nullable=False)
+	status = db.Column(db.String(10), nullable=False, default='pending') #pending, running, done or failed
+	stage = db.Column(db.String(20))
+	total = db.Column(db.Integer, nullable=False, default=0)
+	deleted = db.Column(db.Integer, nullable=False, default=0)
+	images = db.Column(db.Text, nullable=False, default='')
+	error = db.Column(db.Text)
+	requested_by = db.Column(db.Integer) #no foreign key, the requester may be the one purged
+	created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+	started_at = db.Column(db.DateTime)
+	finished_at = db.Column(db.DateTime)
+	__table_args__ = (db.Index('ix_purge_job_kind_target_id', 'kind', 'target_id'),)
+
+	@property
+	def progress(self):
+		if self.status == 'done':
+			return 1.0
+		return min(self.deleted / float(self.total), 1.0) if self.total else 0.0
+
+	# an account being purged can't sign in
+	@staticmethod
+	def purging_user(user_id):
+		return db.session.query(PurgeJob.query.filter(PurgeJob.kind == 'user', PurgeJob.target_id == user_id,
+			PurgeJob.status.in_(('pending', 'running', 'failed'))).exists()).scalar()
+
+	def to_dict(self):
+		return {'id': self.id, 'kind': self.kind, 'target_id': self.target_id, 'status': self.status,
+			'stage': self.stage, 'deleted': self.deleted, 'total': self.total, 'progress': round(self.progress, 3),
+			'error': self.error, 'created_at': self.created_at.isoformat(),
+			'finished_at': self.finished_at.isoformat() if self.finished_at else None}
+
+	def __repr__(self):
+		return '<PurgeJob {} {} {}>'.format(self.kind, self.target_id, self.status)
+
+
+# sanitized html is rendered once, whenever the source text is set, so pages
+# never run markdown or bleach
+db.event.listen(User.bio, 'set', User.on_changed_body)
+db.event.listen(Post.content, 'set', Post.on_changed_body)
+db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Message.body, 'set', Message.on_changed_body)
+
+
+# keep the denormalized post/comment counters in step with inserts and deletes,
+# inside the same flush as the row itself
+def _bump(table, row_id, **deltas):
+	values = {name: table.c[name] + delta for name, delta in deltas.items()}
+	return table.update().where(table.c.id == row_id).values(**values)
+
+@db.event.listens_for(Post, 'after_insert')
+def post_created(mapper, connection, target):
+	connection.execute(_bump(User.__table__, target.user_id, posts_count=1))
+
+@db.event.listens_for(Post, 'after_delete')
+def post_deleted(mapper, connection, target):
+	connection.execute(_bump(User.__table__, target.user_id, posts_count=-1))
+
+# post_tag mirrors post.tags; unknown tags are created on first use
+def _sync_tags(connection, post):
+	tag = Tag.__table__
+	connection.execute(post_tag.delete().where(post_tag.c.post_id == post.id))
+	names = Tag.parse(post.tags)
+	if not names:
+		return
+	known = dict(connection.execute(db.select([tag.c.name, tag.c.id]).where(tag.c.name.in_(names))).fetchall())
+	for name in names:
+		if name not in known:
+			known[name] = connection.execute(tag.insert().values(name=name)).inserted_primary_key[0]
+	connection.execute(post_tag.insert(), [
+		{'post_id': post.id, 'tag_id': known[name], 'date_posted': post.date_posted} for name in names])
+
+@db.event.listens_for(Post, 'after_insert')
+def post_tagged(mapper, connection, target):
+	if target.tags:
+		_sync_tags(connection, target)
+
+@db.event.listens_for(Post, 'after_update')
+def post_retagged(mapper, connection, target):
+	if db.inspect(target).attrs.tags.history.has_changes():
+		_sync_tags(connection, target)
+
+@db.event.listens_for(Post, 'after_delete')
+def post_untagged(mapper, connection, target):
+	connection.execute(post_tag.delete().where(post_tag.c.post_id == target.id))
+
+@db.event.listens_for(Comment, 'after_insert')
+def comment_created(mapper, connection, target):
+	connection.execute(_bump(Post.__table__, target.post_id, comments_count=1))
+
+@db.event.listens_for(Comment, 'after_delete')
+def comment_deleted(mapper, connection, target):
+	connection.execute(_bump(Post.__table__, target.post_id, comments_count=-1))
+
+@db.event.listens_for(Message, 'after_insert')
+def message_created(mapper, connection, target):
+	conversation = Conversation.__table__
+	user_a_id, user_b_id = Conversation.pair(target.sender_id, target.recipient_id)
+	values = {'last_message_id': target.id, 'last_timestamp': target.timestamp}
+	if target.sender_id != target.recipient_id:
+		unread = 'unread_a' if target.recipient_id == user_a_id else 'unread_b'
+		values[unread] = conversation.c[unread] + 1
+	updated = connection.execute(conversation.update().where(db.and_(
+		conversation.c.user_a_id == user_a_id,
+		conversation.c.user_b_id == user_b_id)).values(**values))
+	if not updated.rowcount:
+		values.update(user_a_id=user_a_id, user_b_id=user_b_id,
+			unread_a=int(target.sender_id != target.recipient_id and target.recipient_id == user_a_id),
+			unread_b=int(target.sender_id != target.recipient_id and target.recipient_id == user_b_id))
+		connection.execute(conversation.insert().values(**values))
@@ -0,0 +1,207 @@
+import os
+import random
+import smtplib
+import threading
+import uuid
+import click
+from datetime import datetime, timedelta
+from flask_mail import Message, BadHeaderError
+from sqlalchemy import func, select
+from market import app, db, mail
+from market.models import OutboxMessage
+from market.tasks import queues
+
+# email goes through a table instead of an SMTP call in the request.
+# enqueue() adds a row to the current transaction; once that commits a
+# background thread wakes up, claims a batch of due rows and sends them over
+# one SMTP connection, so an SMTP stall holds up the sender, not a page.
+# failures are retried with exponential backoff up to MAIL_MAX_ATTEMPTS,
+# unless the server refused the message for good (a 5xx reply). every
+# gunicorn worker runs its own sender; claims keep them from sending a row
+# twice. `flask send-mail` drains the outbox from the command line.
+ACTIVE = ('pending', 'sending')
+
+
+def enqueue(subject, recipients, body, html=None, sender=None):
+	message = OutboxMessage(subject=subject, recipients=','.join(recipients), body=body, html=html, sender=sender)
+	db.session.add(message)
+	db.session.info['outbox_enqueued'] = db.session.info.get('outbox_enqueued', 0) + 1
+	return message
+
+def mail_message(row):
+	return Message(subject=row.subject, recipients=row.recipients.split(','), body=row.body, html=row.html,
+		sender=row.sender) #None falls back to MAIL_DEFAULT_SENDER
+
+# a reply that won't change if we ask again, or a message that can't be sent at all
+def permanent(error):
+	if isinstance(error, smtplib.SMTPRecipientsRefused):
+		return all(code >= 500 for code, text in error.recipients.values())
+	if isinstance(error, smtplib.SMTPResponseException):
+		return error.smtp_code >= 500
+	return isinstance(error, (BadHeaderError, AssertionError))
+
+# 2^n times the base delay, capped, with jitter so a batch that failed
+# together doesn't retry together
+def backoff(attempts):
+	delay = min(app.config['MAIL_RETRY_MAX_DELAY'], app.config['MAIL_RETRY_DELAY'] * 2 ** (attempts - 1))
+	return timedelta(seconds=random.uniform(delay / 2.0, delay))
+
+
+class Outbox(object):
+
+	def __init__(self, app):
+		self.app = app
+		self.name = 'mail'
+		self.wakeup = threading.Event()
+		self.lock = threading.Lock()
+		self.thread = None
+		self.pid = None
+		self.counts = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'retried': 0}
+		queues.append(self)
+
+	@property
+	def enabled(self):
+		return self.app.config['MAIL_WORKER']
+
+	# the sender is started with the first request (below), so commands that
+	# enqueue mail and drain it themselves don't start a second one
+	def wake(self):
+		self.wakeup.set()
+
+	# started lazily so each gunicorn worker gets its own sender after the fork
+	def ensure_running(self):
+		if self.thread is not None and self.pid == os.getpid():
+			return
+		with self.lock:
+			if self.thread is not None and self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			self.thread = threading.Thread(target=self.run, name='mail-sender', daemon=True)
+			self.thread.start()
+
+	def run(self):
+		while True:
+			with self.app.app_context():
+				try:
+					self.drain()
+				except Exception:
+					db.session.rollback()
+					self.app.logger.exception('Failed to send queued mail')
+				finally:
+					db.session.remove()
+			self.wakeup.wait(self.app.config['MAIL_POLL_INTERVAL'])
+			self.wakeup.clear()
+
+	# mark up to `limit` due rows as ours in one statement, pushing their
+	# next_attempt_at past the claim timeout, and load them
+	def claim(self, limit):
+		now = datetime.utcnow()
+		due = db.and_(OutboxMessage.status.in_(ACTIVE), OutboxMessage.next_attempt_at <= now)
+		ids = select([OutboxMessage.id]).where(due).order_by(OutboxMessage.next_attempt_at).limit(limit)
+		token = uuid.uuid4().hex
+		OutboxMessage.query.filter(OutboxMessage.id.in_(ids), due).update({'status': 'sending', 'claim': token,
+			'next_attempt_at': now + timedelta(seconds=self.app.config['MAIL_CLAIM_TIMEOUT'])},
+			synchronize_session=False)
+		db.session.commit()
+		return OutboxMessage.query.filter(OutboxMessage.status == 'sending', OutboxMessage.claim == token).order_by(
+			OutboxMessage.id).all()
+
+	# send batches until nothing is due; returns how many went out, were
+	# put back for a retry and were given up on
+	def drain(self):
+		before = dict(self.counts)
+		while True:
+			batch = self.claim(self.app.config['MAIL_BATCH_SIZE'])
+			if not batch:
+				break
+			self.send_batch(batch)
+		return {key: self.counts[key] - before[key] for key in ('completed', 'retried', 'failed')}
+
+	# one connection for the whole batch. a message the server turns down is
+	# retried or failed on its own; losing the connection puts back every
+	# message not yet sent
+	def send_batch(self, batch):
+		unsent = list(batch)
+		try:
+			with mail.connect() as connection:
+				if connection.host is not None and connection.host.sock is not None:
+					connection.host.sock.settimeout(self.app.config['MAIL_TIMEOUT'])
+				while unsent:
+					message = unsent[0]
+					try:
+						connection.send(mail_message(message))
+					except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException, BadHeaderError,
+							AssertionError) as e:
+						self.failed(message, e, permanent(e))
+					else:
+						self.sent(message)
+					unsent.pop(0)
+		except (smtplib.SMTPException, OSError) as e:
+			for message in unsent:
+				self.failed(message, e, False)
+
+	def sent(self, message):
+		db.session.delete(message)
+		db.session.commit()
+		self.counts['completed'] += 1
+
+	def failed(self, message, error, give_up):
+		message.attempts += 1
+		message.claim = None
+		message.last_error = '{}: {}'.format(type(error).__name__, error)[:1000]
+		if give_up or message.attempts >= self.app.config['MAIL_MAX_ATTEMPTS']:
+			message.status = 'failed'
+			self.counts['failed'] += 1
+			self.app.logger.error('Gave up on mail %d to %s after %d attempt(s): %s', message.id, message.recipients,
+				message.attempts, message.last_error)
+		else:
+			message.status = 'pending'
+			message.next_attempt_at = datetime.utcnow() + backoff(message.attempts)
+			self.counts['retried'] += 1
+		db.session.commit()
+
+	# put messages that were given up on back in the queue
+	def retry_failed(self):
+		count = OutboxMessage.query.filter_by(status='failed').update({'status': 'pending', 'attempts': 0,
+			'next_attempt_at': datetime.utcnow()}, synchronize_session=False)
+		db.session.commit()
+		return count
+
+	# shaped like TaskQueue.stats() for /admin/queues and /metrics. depth and
+	# the oldest wait come from the table, so they cover every worker; the
+	# counts are this process's. the outbox never turns a message away, so
+	# nothing is 'rejected'
+	def stats(self):
+		by_status = dict(db.session.query(OutboxMessage.status, func.count(OutboxMessage.id)).group_by(
+			OutboxMessage.status))
+		oldest = db.session.query(func.min(OutboxMessage.created_at)).filter(
+			OutboxMessage.status.in_(ACTIVE)).scalar()
+		waited = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+		return dict(self.counts,
+			name=self.name,
+			workers=1 if self.enabled else 0,
+			depth=by_status.get('pending', 0) + by_status.get('sending', 0),
+			sending=by_status.get('sending', 0),
+			undeliverable=by_status.get('failed', 0),
+			wait_max_ms=round(waited * 1000, 1))
+
+
+outbox = Outbox(app)
+
+@db.event.listens_for(db.session, 'after_commit')
+def wake_sender(session):
+	enqueued = session.info.pop('outbox_enqueued', 0)
+	if enqueued:
+		outbox.counts['submitted'] += enqueued
+		outbox.wake()
+
+@db.event.listens_for(db.session, 'after_rollback')
+def forget_enqueued(session):
+	session.info.pop('outbox_enqueued', None)
+
+# pick up whatever was left queued by the last run. requests a command makes
+# through the test client (bench, explain-queries) don't start it
+@app.before_first_request
+def start_sender():
+	if outbox.enabled and click.get_current_context(silent=True) is None:
+		outbox.ensure_running()
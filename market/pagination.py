@@ -0,0 +1,106 @@
+import operator
+from datetime import datetime
+from flask import request, render_template, jsonify
+from flask_login import current_user
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+from market import app
+from market.models import Post, Message
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+# keyset (cursor) pagination over (date_posted, id), newest first.
+# the cursor is the sort key of the last post on the page, so every page
+# is an index range scan no matter how deep the reader scrolls.
+def encode_cursor(when, row_id):
+	return '{}-{}'.format(when.strftime(CURSOR_FORMAT), row_id)
+
+def decode_cursor(cursor):
+	try:
+		stamp, post_id = cursor.split('-')
+		return datetime.strptime(stamp, CURSOR_FORMAT), int(post_id)
+	except (AttributeError, ValueError):
+		return None
+
+def page_size():
+	per_page = request.args.get('limit', app.config['POSTS_PER_PAGE'], type=int)
+	return max(1, min(per_page, app.config['POSTS_PER_PAGE_MAX']))
+
+# `key` swaps in equivalent sort columns from a joined table whose index
+# should drive the scan, e.g. (post_tag.c.date_posted, post_tag.c.post_id).
+# the cursor filters repeat the leading bound outside the OR, since sqlite
+# only turns a plain comparison into a range on the index
+def paginate_posts(query, cursor=None, per_page=None, key=None):
+	per_page = per_page or page_size()
+	date_column, id_column = key or (Post.date_posted, Post.id)
+	position = decode_cursor(cursor) if cursor else None
+	if position:
+		date_posted, post_id = position
+		query = query.filter(date_column <= date_posted, or_(date_column < date_posted,
+			and_(date_column == date_posted, id_column < post_id)))
+	query = query.options(joinedload(Post.author))
+	posts = query.order_by(None).order_by(date_column.desc(), id_column.desc()).limit(per_page + 1).all()
+	last = posts[per_page - 1] if len(posts) > per_page else None
+	next_cursor = encode_cursor(last.date_posted, last.id) if last else None
+	return posts[:per_page], next_cursor
+
+# keyset pagination by price within one currency, cheapest first or, with
+# `descending`, dearest first. ties go by (date_posted, id) in the same
+# direction so the whole order comes straight off the price index. the
+# cursor is "amount-<date cursor>" of the last post on the page
+def encode_price_cursor(post):
+	return '{}-{}'.format(post.price_amount, encode_cursor(post.date_posted, post.id))
+
+def decode_price_cursor(cursor):
+	try:
+		amount, rest = cursor.split('-', 1)
+		position = decode_cursor(rest)
+		return (int(amount),) + position if position else None
+	except (AttributeError, ValueError):
+		return None
+
+def paginate_by_price(query, cursor=None, per_page=None, descending=False):
+	per_page = per_page or page_size()
+	beyond = operator.lt if descending else operator.gt
+	at_or_beyond = operator.le if descending else operator.ge
+	position = decode_price_cursor(cursor) if cursor else None
+	if position:
+		amount, date_posted, post_id = position
+		query = query.filter(at_or_beyond(Post.price_amount, amount), or_(
+			beyond(Post.price_amount, amount), and_(Post.price_amount == amount, or_(
+			beyond(Post.date_posted, date_posted), and_(Post.date_posted == date_posted, beyond(Post.id, post_id))))))
+	order = [Post.price_amount, Post.date_posted, Post.id]
+	query = query.options(joinedload(Post.author)).order_by(None).order_by(
+		*[column.desc() if descending else column for column in order])
+	posts = query.limit(per_page + 1).all()
+	last = posts[per_page - 1] if len(posts) > per_page else None
+	return posts[:per_page], encode_price_cursor(last) if last else None
+
+# a chat thread pages backwards from the newest message; returns the page in
+# reading order plus a cursor for the older messages before it
+def paginate_thread(query, cursor=None, per_page=None):
+	per_page = per_page or app.config['MESSAGES_PER_PAGE']
+	position = decode_cursor(cursor) if cursor else None
+	if position:
+		timestamp, message_id = position
+		query = query.filter(Message.timestamp <= timestamp, or_(Message.timestamp < timestamp,
+			and_(Message.timestamp == timestamp, Message.id < message_id)))
+	messages = query.order_by(None).order_by(Message.timestamp.desc(), Message.id.desc()).limit(per_page + 1).all()
+	oldest = messages[per_page - 1] if len(messages) > per_page else None
+	older_cursor = encode_cursor(oldest.timestamp, oldest.id) if oldest else None
+	return messages[:per_page][::-1], older_cursor
+
+# per-viewer state for the visible page, resolved up front so the cards
+# don't issue a query each
+def viewer_context(posts):
+	if not current_user.is_authenticated:
+		return {'liked_ids': set()}
+	return {'liked_ids': current_user.liked_post_ids(posts)}
+
+# full page on a normal request, just the next batch of cards for "load more"
+def render_feed(template, posts, next_cursor, **context):
+	context.update(viewer_context(posts))
+	if request.args.get('partial'):
+		html = render_template('_post_cards.html', posts=posts, **context)
+		return jsonify(html=html, next_cursor=next_cursor)
+	return render_template(template, posts=posts, next_cursor=next_cursor, **context)
@@ -0,0 +1,80 @@
+import atexit
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+from market import app, db
+from market.cache import TTLCache
+from market.models import User
+
+
+# buffers last_seen timestamps in memory and writes them back in one batched
+# UPDATE from a background thread, so page views never take the write lock.
+class PresenceTracker(object):
+
+	def __init__(self, app):
+		self.app = app
+		self.pending = {}
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.thread = None
+		self.pid = None
+		#what was last written per user; current_user.last_seen is a cached
+		#snapshot (see market/identity.py) and lags behind it
+		self.written = TTLCache(maxsize=app.config['IDENTITY_CACHE_SIZE'], ttl=app.config['PRESENCE_STALE_AFTER'])
+		atexit.register(self.flush)
+
+	@property
+	def interval(self):
+		return self.app.config['PRESENCE_FLUSH_INTERVAL']
+
+	@property
+	def stale_after(self):
+		return timedelta(seconds=self.app.config['PRESENCE_STALE_AFTER'])
+
+	def touch(self, user):
+		now = datetime.utcnow()
+		with self.lock:
+			self.pending[user.id] = now
+		self.ensure_running()
+		# flush early rather than let a user's stored last_seen drift too far
+		last_seen = self.written.get(user.id, user.last_seen)
+		if last_seen is None or now - last_seen > self.stale_after:
+			self.wakeup.set()
+
+	def flush(self):
+		with self.lock:
+			seen, self.pending = self.pending, {}
+		if not seen:
+			return 0
+		update = User.__table__.update().where(
+			User.__table__.c.id == bindparam('user_id')).values(last_seen=bindparam('seen'))
+		with self.app.app_context():
+			with db.engine.begin() as connection:
+				connection.execute(update, [{'user_id': user_id, 'seen': when} for user_id, when in seen.items()])
+		for user_id, when in seen.items():
+			self.written.set(user_id, when)
+		return len(seen)
+
+	# started lazily so each gunicorn worker gets its own flusher after the fork
+	def ensure_running(self):
+		if self.thread is not None and self.pid == os.getpid():
+			return
+		with self.lock:
+			if self.thread is not None and self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			self.thread = threading.Thread(target=self.run, name='presence-flusher', daemon=True)
+			self.thread.start()
+
+	def run(self):
+		while True:
+			self.wakeup.wait(self.interval)
+			self.wakeup.clear()
+			try:
+				self.flush()
+			except Exception:
+				self.app.logger.exception('Failed to flush last_seen updates')
+
+
+presence = PresenceTracker(app)
@@ -0,0 +1,70 @@
+import math
+import re
+from decimal import Decimal, InvalidOperation
+
+# prices are typed free-form ("$5500", "225TL", "1,200.50 EUR") and stored
+# twice: the text as typed for display, and an integer amount in minor units
+# (cents, kuruş) plus an ISO 4217 code for sorting and range filters
+
+# symbols and suffixes sellers type, lowercased
+CURRENCY_SYMBOLS = {'$': 'USD', 'us$': 'USD', '€': 'EUR', '£': 'GBP', '₺': 'TRY', 'tl': 'TRY',
+	'ksh': 'KES', 'kshs': 'KES'}
+# the currencies offered in filters
+CURRENCIES = ('USD', 'EUR', 'GBP', 'TRY', 'KES')
+# digits after the decimal point; anything not listed has 2
+MINOR_DIGITS = {'JPY': 0, 'KRW': 0}
+MAX_AMOUNT = 10 ** 12 #minor units
+
+PRICE_PATTERN = re.compile(r'^(?P<before>[^\d.,]*?)\s*(?P<number>\d[\d,\s]*(?:\.\d+)?)\s*(?P<after>[^\d.,]*)$')
+
+PRICE_HELP = 'Enter a price like 250, $25.50 or 225 TL.'
+
+
+def minor_digits(currency):
+	return MINOR_DIGITS.get(currency, 2)
+
+def currency_code(token, default):
+	token = token.strip().lower()
+	if not token:
+		return default
+	if token in CURRENCY_SYMBOLS:
+		return CURRENCY_SYMBOLS[token]
+	if re.match(r'^[a-z]{3}$', token):
+		return token.upper()
+	raise ValueError(PRICE_HELP)
+
+# "12,50" reads as a decimal comma, "1,200" and "1 200" as thousands
+def _decimal(number):
+	number = number.strip()
+	if '.' not in number and re.search(r',\d{1,2}$', number):
+		number = number[:number.rindex(',')] + '.' + number[number.rindex(',') + 1:]
+	try:
+		return Decimal(re.sub(r'[,\s]', '', number))
+	except InvalidOperation:
+		raise ValueError(PRICE_HELP)
+
+# "$25.50" -> (2550, 'USD'); raises ValueError with a message for the form
+def parse_price(text, default_currency):
+	match = PRICE_PATTERN.match((text or '').strip())
+	if not match or (match.group('before').strip() and match.group('after').strip()):
+		raise ValueError(PRICE_HELP)
+	currency = currency_code(match.group('before') or match.group('after'), default_currency)
+	return to_minor(_decimal(match.group('number')), currency), currency
+
+# a major unit amount in minor units, refusing fractions the currency doesn't have
+def to_minor(amount, currency):
+	minor = Decimal(amount) * 10 ** minor_digits(currency)
+	if minor != minor.to_integral_value():
+		raise ValueError('{} has at most {} decimal places.'.format(currency, minor_digits(currency)))
+	if not 0 <= minor <= MAX_AMOUNT:
+		raise ValueError(PRICE_HELP)
+	return int(minor)
+
+# a filter bound in major units, rounded to the nearest minor unit. bounds
+# from the query string that aren't numbers (nan, inf) are ignored, and the
+# rest clamped to the amounts a price can have before they are scaled
+def filter_amount(value, currency):
+	if value is None or not math.isfinite(value):
+		return None
+	scale = 10 ** minor_digits(currency)
+	return int(round(min(max(value, 0.0), MAX_AMOUNT / scale) * scale))
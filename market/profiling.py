@@ -0,0 +1,199 @@
+import hmac
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import g, has_request_context, request, Response, abort
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from market import app
+from market.tasks import queues
+
+
+# per request query accounting on top of the engine events. every statement
+# run while a request is being served is counted and timed; the statement
+# text is its fingerprint, since sqlalchemy sends the same sql with different
+# bound parameters, so one statement repeated many times in a request is the
+# shape of an N+1 (a lazy load or a count per post in a template). the work
+# per query is a perf_counter call and a dict increment, cheap enough to
+# leave on in production. PROFILING_ENABLED=0 turns it off.
+class RequestStats(object):
+	__slots__ = ('started', 'queries', 'seconds', 'statements')
+
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.queries = 0
+		self.seconds = 0.0
+		self.statements = Counter()
+
+	# the statement run most often, and how often
+	def most_repeated(self):
+		if not self.statements:
+			return None, 0
+		return self.statements.most_common(1)[0]
+
+
+def enabled():
+	return app.config['PROFILING_ENABLED']
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+	if has_request_context() and g.get('db_stats') is not None:
+		conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+	stats = g.get('db_stats') if has_request_context() else None
+	started = conn.info.get('query_started')
+	if stats is None or not started:
+		return
+	stats.seconds += time.perf_counter() - started.pop()
+	stats.queries += 1
+	stats.statements[statement] += 1
+
+@event.listens_for(Engine, 'handle_error')
+def failed_query(context):
+	started = context.connection.info.get('query_started') if context.connection is not None else None
+	if started:
+		started.pop()
+
+
+# cumulative prometheus histograms, kept per process: with several gunicorn
+# workers each one reports its own series and the scraper adds them up
+class Histogram(object):
+
+	def __init__(self, name, help, buckets, labels):
+		self.name = name
+		self.help = help
+		self.buckets = buckets
+		self.labels = labels
+		self.counts = defaultdict(lambda: [0] * (len(buckets) + 1))
+		self.sums = defaultdict(float)
+
+	def observe(self, label_values, value):
+		counts = self.counts[label_values]
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				counts[i] += 1
+				break
+		else:
+			counts[-1] += 1
+		self.sums[label_values] += value
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} histogram'.format(self.name)]
+		for label_values, counts in sorted(self.counts.items()):
+			labels = format_labels(zip(self.labels, label_values))
+			total = 0
+			for bound, count in zip(self.buckets + ('+Inf',), counts):
+				total += count
+				lines.append('{}_bucket{{{}le="{}"}} {}'.format(self.name, labels + ',' if labels else '', bound, total))
+			lines.append('{}_sum{{{}}} {}'.format(self.name, labels, round(self.sums[label_values], 6)))
+			lines.append('{}_count{{{}}} {}'.format(self.name, labels, total))
+		return lines
+
+
+class Counters(object):
+
+	def __init__(self, name, help, labels):
+		self.name = name
+		self.help = help
+		self.labels = labels
+		self.values = Counter()
+
+	def inc(self, label_values, amount=1):
+		self.values[label_values] += amount
+
+	def render(self):
+		lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} counter'.format(self.name)]
+		for label_values, value in sorted(self.values.items()):
+			lines.append('{}{{{}}} {}'.format(self.name, format_labels(zip(self.labels, label_values)), round(value, 6)))
+		return lines
+
+
+def format_labels(pairs):
+	return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in pairs)
+
+
+metrics_lock = threading.Lock()
+request_duration = Histogram('http_request_duration_seconds', 'Time to serve a request.',
+	(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0), ('endpoint', 'method'))
+request_queries = Histogram('db_queries_per_request', 'Database queries run while serving one request.',
+	(1, 2, 5, 10, 20, 50, 100, 200, 500), ('endpoint',))
+query_seconds = Counters('db_query_seconds_total', 'Time spent in database queries.', ('endpoint',))
+responses = Counters('http_responses_total', 'Responses sent, by status code.', ('endpoint', 'status'))
+slow_requests = Counters('slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.', ('endpoint',))
+n_plus_one = Counters('n_plus_one_requests_total',
+	'Requests that ran one statement at least N_PLUS_ONE_THRESHOLD times.', ('endpoint',))
+
+
+@app.before_request
+def start_request():
+	if enabled():
+		g.db_stats = RequestStats()
+
+@app.after_request
+def finish_request(response):
+	stats = g.pop('db_stats', None)
+	if stats is None:
+		return response
+	elapsed = time.perf_counter() - stats.started
+	endpoint = request.endpoint or 'unmatched'
+	statement, repeats = stats.most_repeated()
+	flagged = repeats >= app.config['N_PLUS_ONE_THRESHOLD']
+	slow = elapsed * 1000 >= app.config['SLOW_REQUEST_MS']
+	with metrics_lock:
+		request_duration.observe((endpoint, request.method), elapsed)
+		request_queries.observe((endpoint,), stats.queries)
+		query_seconds.inc((endpoint,), stats.seconds)
+		responses.inc((endpoint, response.status_code))
+		if slow:
+			slow_requests.inc((endpoint,))
+		if flagged:
+			n_plus_one.inc((endpoint,))
+	if app.config['PROFILING_HEADERS']:
+		response.headers['Server-Timing'] = 'db;dur={:.1f};desc="{} queries", app;dur={:.1f}'.format(
+			stats.seconds * 1000, stats.queries, elapsed * 1000)
+		response.headers['X-Query-Count'] = str(stats.queries)
+		if flagged:
+			response.headers['X-Query-Repeated'] = str(repeats)
+	if slow:
+		app.logger.warning('slow request %s %s: %.0fms, %d queries in %.0fms', request.method, request.full_path,
+			elapsed * 1000, stats.queries, stats.seconds * 1000)
+	if flagged:
+		app.logger.warning('possible N+1 in %s: %d runs of %s', endpoint, repeats, ' '.join(statement.split())[:300])
+	return response
+
+
+def queue_lines():
+	lines = []
+	for name, help, kind, key in (('task_queue_depth', 'Jobs waiting in a background queue.', 'gauge', 'depth'),
+			('task_queue_wait_max_seconds', 'Longest recent wait before a job started.', 'gauge', 'wait_max_ms'),
+			('task_queue_jobs_total', 'Jobs by outcome.', 'counter', None)):
+		lines += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+		for task_queue in queues:
+			stats = task_queue.stats()
+			if key is None:
+				for outcome in ('submitted', 'completed', 'failed', 'rejected'):
+					lines.append('{}{{{}}} {}'.format(name, format_labels([('queue', stats['name']),
+						('outcome', outcome)]), stats[outcome]))
+			else:
+				value = stats[key] / 1000.0 if key.endswith('_ms') else stats[key]
+				lines.append('{}{{{}}} {}'.format(name, format_labels([('queue', stats['name'])]), value))
+	return lines
+
+# prometheus text format. with METRICS_TOKEN set the scraper sends it as a
+# bearer token; without one only local requests are answered
+@app.route('/metrics')
+def metrics():
+	token = app.config['METRICS_TOKEN']
+	if token:
+		if not hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token):
+			abort(403)
+	elif request.remote_addr not in ('127.0.0.1', '::1'):
+		abort(403)
+	with metrics_lock:
+		lines = []
+		for metric in (request_duration, request_queries, query_seconds, responses, slow_requests, n_plus_one):
+			lines += metric.render()
+	lines += queue_lines()
+	return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
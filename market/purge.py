@@ -0,0 +1,257 @@
+import time
+import click
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import and_, bindparam, or_, select
+from market import app, db
+from market.models import (User, Post, PostLike, Comment, Message, Conversation, StoredImage, PurgeJob,
+	followers, post_tag, timeline, _bump)
+from market.images import remove_image
+from market.identity import identities
+from market.directory import directory
+from market.tasks import TaskQueue
+from market.timeline import fans_out
+
+# deleting an account used to load and delete every post, like, comment and
+# follow through the ORM in one request and one transaction. now the request
+# records a PurgeJob and returns; the job deletes the rows with plain DELETEs
+# of at most PURGE_BATCH_SIZE rows, each batch its own short transaction that
+# also fixes up the counters the mapper events would have kept, and records
+# its progress on the job. the uploads it let go of are removed at the end.
+# a job that died half way can be run again with `flask run-purges --retry`:
+# every stage picks up whatever is left.
+purge_queue = TaskQueue(app, 'purge', app.config['PURGE_WORKERS'], 100)
+
+# shared by every account that never uploaded a picture
+PROTECTED = {('profile_pics', 'default.png')}
+
+
+def _ids(query):
+	return [row_id for row_id, in db.session.execute(query)]
+
+def _delete_ids(table, ids):
+	if ids:
+		db.session.execute(table.delete().where(table.c.id.in_(ids)))
+	return len(ids)
+
+# subtract per-row amounts from a counter column, in one statement
+def _decrement(table, column, counts):
+	if counts:
+		db.session.execute(table.update().where(table.c.id == bindparam('row_id')).values(
+			{column: table.c[column] - bindparam('amount')}),
+			[{'row_id': row_id, 'amount': amount} for row_id, amount in counts.items()])
+
+# what the image mapper events would do for deleted rows: drop the reference
+# counts, and remember the names so their files can go once nothing uses them
+def _release_images(job, folder, filenames):
+	stored = StoredImage.__table__
+	counts = Counter(fn for fn in filenames if fn)
+	for filename, amount in counts.items():
+		db.session.execute(stored.update().where(and_(stored.c.folder == folder, stored.c.filename == filename)).values(
+			refcount=stored.c.refcount - amount))
+	job.images = '\n'.join([entry for entry in job.images.split('\n') if entry] +
+		['{}/{}'.format(folder, filename) for filename in counts])
+
+# run `step` until it deletes nothing, committing each batch together with
+# the job's progress and pausing between batches so other writers get a turn
+def _run_stage(job, name, step):
+	job.stage = name
+	db.session.commit()
+	while True:
+		deleted = step(app.config['PURGE_BATCH_SIZE'])
+		if not deleted:
+			return
+		job.deleted += deleted
+		db.session.commit()
+		time.sleep(app.config['PURGE_BATCH_PAUSE'])
+
+# remove the files of uploads nothing points at any more. an image still
+# used elsewhere (the same picture uploaded twice) keeps its file
+def _remove_files(job):
+	job.stage = 'files'
+	db.session.commit()
+	names = {tuple(entry.split('/', 1)) for entry in job.images.split('\n') if entry}
+	for folder, filename in sorted(names - PROTECTED):
+		image = StoredImage.query.filter_by(folder=folder, filename=filename).first()
+		if image is None or image.refcount > 0:
+			continue
+		db.session.delete(image)
+		db.session.commit()
+		remove_image(folder, filename)
+
+
+def _user_stages(job):
+	user_id = job.target_id
+	user, post, comment, like = User.__table__, Post.__table__, Comment.__table__, PostLike.__table__
+	conversation, message = Conversation.__table__, Message.__table__
+	own_posts = select([post.c.id]).where(post.c.user_id == user_id)
+
+	def comments_on_posts(limit):
+		return _delete_ids(comment, _ids(select([comment.c.id]).where(comment.c.post_id.in_(own_posts)).limit(limit)))
+
+	def likes_on_posts(limit):
+		return _delete_ids(like, _ids(select([like.c.id]).where(like.c.post_id.in_(own_posts)).limit(limit)))
+
+	# every post has a timeline row per follower, so fewer posts per batch
+	# for a user with a big following
+	followers_count = db.session.query(User.followers_count).filter(User.id == user_id).scalar() or 0
+	fan_out = followers_count + 1 if fans_out(followers_count) else 1
+
+	def posts(limit):
+		rows = db.session.execute(select([post.c.id, post.c.image, post.c.image2, post.c.image3]).where(
+			post.c.user_id == user_id).limit(max(1, limit // fan_out))).fetchall()
+		ids = [row[0] for row in rows]
+		if not ids:
+			return 0
+		deleted = db.session.execute(timeline.delete().where(timeline.c.post_id.in_(ids))).rowcount
+		deleted += db.session.execute(post_tag.delete().where(post_tag.c.post_id.in_(ids))).rowcount
+		_release_images(job, 'posts', [filename for row in rows for filename in row[1:]])
+		db.session.execute(_bump(user, user_id, posts_count=-len(ids)))
+		return deleted + _delete_ids(post, ids)
+
+	def comments(limit):
+		rows = db.session.execute(select([comment.c.id, comment.c.post_id]).where(
+			comment.c.user_id == user_id).limit(limit)).fetchall()
+		_decrement(post, 'comments_count', Counter(post_id for _, post_id in rows))
+		return _delete_ids(comment, [row_id for row_id, _ in rows])
+
+	def likes(limit):
+		rows = db.session.execute(select([like.c.id, like.c.post_id]).where(
+			like.c.user_id == user_id).limit(limit)).fetchall()
+		_decrement(post, 'likes_count', Counter(post_id for _, post_id in rows if post_id is not None))
+		return _delete_ids(like, [row_id for row_id, _ in rows])
+
+	def following(limit):
+		ids = _ids(select([followers.c.followed_id]).where(followers.c.follower_id == user_id).limit(limit))
+		_decrement(user, 'followers_count', Counter(ids))
+		if ids:
+			db.session.execute(followers.delete().where(and_(followers.c.follower_id == user_id,
+				followers.c.followed_id.in_(ids))))
+		return len(ids)
+
+	def followed_by(limit):
+		ids = _ids(select([followers.c.follower_id]).where(followers.c.followed_id == user_id).limit(limit))
+		_decrement(user, 'following_count', Counter(ids))
+		if ids:
+			db.session.execute(followers.delete().where(and_(followers.c.followed_id == user_id,
+				followers.c.follower_id.in_(ids))))
+		return len(ids)
+
+	def feed(limit):
+		ids = _ids(select([timeline.c.post_id]).where(timeline.c.user_id == user_id).limit(limit))
+		if ids:
+			db.session.execute(timeline.delete().where(and_(timeline.c.user_id == user_id,
+				timeline.c.post_id.in_(ids))))
+		return len(ids)
+
+	def conversations(limit):
+		return _delete_ids(conversation, _ids(select([conversation.c.id]).where(
+			Conversation.involving(user_id)).limit(limit)))
+
+	def messages(limit):
+		return _delete_ids(message, _ids(select([message.c.id]).where(
+			or_(message.c.sender_id == user_id, message.c.recipient_id == user_id)).limit(limit)))
+
+	return [('comments_on_posts', comments_on_posts), ('likes_on_posts', likes_on_posts), ('posts', posts),
+		('comments', comments), ('likes', likes), ('following', following), ('followers', followed_by),
+		('feed', feed), ('conversations', conversations), ('messages', messages)]
+
+def _count_user_rows(user_id):
+	own_posts = db.session.query(Post.id).filter(Post.user_id == user_id)
+	counts = [
+		Comment.query.filter(or_(Comment.user_id == user_id, Comment.post_id.in_(own_posts))),
+		PostLike.query.filter(or_(PostLike.user_id == user_id, PostLike.post_id.in_(own_posts))),
+		own_posts,
+		db.session.query(timeline).filter(or_(timeline.c.user_id == user_id, timeline.c.author_id == user_id)),
+		db.session.query(post_tag).filter(post_tag.c.post_id.in_(own_posts)),
+		db.session.query(followers).filter(or_(followers.c.follower_id == user_id, followers.c.followed_id == user_id)),
+		Conversation.query.filter(Conversation.involving(user_id)),
+		Message.query.filter(or_(Message.sender_id == user_id, Message.recipient_id == user_id)),
+	]
+	return sum(query.count() for query in counts) + 1
+
+def purge_user_rows(job):
+	user_id = job.target_id
+	job.total = _count_user_rows(user_id)
+	# a second pass picks up anything the account wrote from another
+	# session while the first one ran
+	for _ in range(2):
+		for name, step in _user_stages(job):
+			_run_stage(job, name, step)
+	job.stage = 'account'
+	dp = db.session.query(User.dp).filter(User.id == user_id).scalar()
+	_release_images(job, 'profile_pics', [dp])
+	job.deleted += db.session.execute(User.__table__.delete().where(User.__table__.c.id == user_id)).rowcount
+	db.session.commit()
+	identities.bump(user_id)
+	directory.invalidate()
+
+# the post itself is already gone (see purge_post); what's left are its
+# likes and comments wherever the database doesn't cascade the delete
+def purge_post_rows(job):
+	post_id = job.target_id
+	comment, like = Comment.__table__, PostLike.__table__
+	job.total = Comment.query.filter_by(post_id=post_id).count() + PostLike.query.filter_by(post_id=post_id).count()
+	_run_stage(job, 'comments', lambda limit: _delete_ids(comment, _ids(select([comment.c.id]).where(
+		comment.c.post_id == post_id).limit(limit))))
+	_run_stage(job, 'likes', lambda limit: _delete_ids(like, _ids(select([like.c.id]).where(
+		like.c.post_id == post_id).limit(limit))))
+
+PURGES = {'user': purge_user_rows, 'post': purge_post_rows}
+
+
+# claim the job with a conditional update so two workers can't both run it
+def run_purge(job_id):
+	claimed = PurgeJob.query.filter(PurgeJob.id == job_id, PurgeJob.status == 'pending').update(
+		{'status': 'running', 'started_at': datetime.utcnow(), 'error': None}, synchronize_session=False)
+	db.session.commit()
+	if not claimed:
+		return False
+	job = PurgeJob.query.get(job_id)
+	try:
+		PURGES[job.kind](job)
+		_remove_files(job)
+		job.status, job.stage, job.finished_at = 'done', None, datetime.utcnow()
+		db.session.commit()
+	except Exception as e:
+		db.session.rollback()
+		app.logger.exception('Purge of %s %d failed', job.kind, job.target_id)
+		job.status, job.error = 'failed', '{}: {}'.format(type(e).__name__, e)[:1000]
+		db.session.commit()
+	return True
+
+def _start(job):
+	db.session.add(job)
+	db.session.commit()
+	purge_queue.submit_or_run(run_purge, job.id)
+	return job
+
+def purge_user(user, requested_by=None):
+	job = PurgeJob.query.filter(PurgeJob.kind == 'user', PurgeJob.target_id == user.id,
+		PurgeJob.status.in_(('pending', 'running'))).first()
+	return job or _start(PurgeJob(kind='user', target_id=user.id, requested_by=requested_by))
+
+# the post row goes right away through the ORM, so the mapper events still
+# fix up counters, tags, the timeline and image counts; its likes and
+# comments aren't loaded (passive_deletes) and are left to the job
+def purge_post(post, requested_by=None):
+	job = PurgeJob(kind='post', target_id=post.id, requested_by=requested_by, images='\n'.join(
+		'posts/{}'.format(filename) for filename in (post.image, post.image2, post.image3) if filename))
+	db.session.delete(post)
+	return _start(job)
+
+# jobs a crash or a restart left behind
+def unfinished_jobs(retry=False):
+	if retry:
+		PurgeJob.query.filter(PurgeJob.status.in_(('running', 'failed'))).update({'status': 'pending'},
+			synchronize_session=False)
+		db.session.commit()
+	return [job_id for job_id, in db.session.query(PurgeJob.id).filter_by(status='pending').order_by(PurgeJob.id)]
+
+# queue whatever was still pending when the app last stopped. jobs cut short
+# while running are left to `flask run-purges --retry`
+@app.before_first_request
+def resume_purges():
+	if click.get_current_context(silent=True) is None:
+		for job_id in unfinished_jobs():
+			purge_queue.submit(run_purge, job_id)
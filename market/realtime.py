@@ -0,0 +1,63 @@
+from flask import url_for
+from flask_login import current_user
+from flask_socketio import join_room
+from market import db, socketio
+from market.models import User, Conversation
+
+
+# every signed in browser tab joins a room named after its user, so a push
+# reaches all of that user's tabs and nobody else
+def user_room(user_id):
+	return 'user:{}'.format(user_id)
+
+@socketio.on('connect')
+def connect():
+	if not current_user.is_authenticated:
+		return False
+	join_room(user_room(current_user.id))
+	socketio.emit('unread', {'count': current_user.new_messages()}, room=user_room(current_user.id))
+
+# the open chat page saw a new message arrive, so it has been read
+@socketio.on('read')
+def read(data):
+	if not current_user.is_authenticated:
+		return
+	other = User.query.filter_by(username=str(data.get('username', '')).lower()).first()
+	conversation = Conversation.between(current_user, other) if other else None
+	if conversation and conversation.unread_for(current_user):
+		conversation.mark_read(current_user)
+		db.session.commit()
+		push_unread(current_user)
+
+
+def message_payload(message):
+	return {
+		'id': message.id,
+		'sender': message.author.username,
+		'recipient': message.recipient.username,
+		'sender_dp': url_for('static', filename='profile_pics/' + message.author.dp),
+		'html': message.body_html,
+		'timestamp': message.timestamp.strftime('%a %H:%M'),
+	}
+
+def push_unread(user):
+	socketio.emit('unread', {'count': user.new_messages()}, room=user_room(user.id))
+
+# call after the message is committed: both sides see it in any open chat,
+# and the recipient's unread badge updates
+def push_message(message):
+	payload = message_payload(message)
+	socketio.emit('message', payload, room=user_room(message.recipient_id))
+	if message.sender_id != message.recipient_id:
+		socketio.emit('message', payload, room=user_room(message.sender_id))
+		push_unread(message.recipient)
+
+def push_like(post, user):
+	if post.user_id == user.id:
+		return
+	socketio.emit('like', {
+		'post_id': post.id,
+		'title': post.title,
+		'username': user.username,
+		'url': url_for('post', post_id=post.id),
+	}, room=user_room(post.user_id))
@@ -2,25 +2,45 @@ import os
 from datetime import datetime
 import secrets
 from PIL import Image
-from flask import render_template, url_for, flash, redirect, request, abort
+from flask import render_template, url_for, flash, redirect, request, abort, jsonify
 from market import app, db, bcrypt, mail
-from market.forms import RegistrationForm, LoginForm, PostForm, HomeForm, CommentForm, UpdateAccountForm, MessageForm
-from market.models import User, Post, Message as m, Comment
+from market.forms import RegistrationForm, LoginForm, RequestResetForm, ResetPasswordForm, PostForm, HomeForm, CommentForm, UpdateAccountForm, MessageForm
+from market.models import User, Post, PostLike, Message as m, Comment, Conversation, Tag, PurgeJob, post_tag
 from market.functions import profile_img, market_img, post_img
+from market.tasks import queues
+from market.images import process_post_images, process_profile_image
+from market.pagination import paginate_posts, paginate_by_price, paginate_thread, page_size, render_feed, viewer_context
+from market.search import search_posts
+from market.prices import CURRENCIES, filter_amount
+from market.tags import trending_tags
+from market.fragments import invalidate_post
+from market.realtime import push_message, push_like, message_payload
+from market.timeline import timeline_page, backfill_timeline, prune_timeline
+from market.presence import presence
+from market.directory import directory
+from market.outbox import enqueue
+from market.purge import purge_user, purge_post
 from flask_login import login_user, current_user, logout_user, login_required
 from flask_mail import Message
+from sqlalchemy import and_, or_
 
 
 @app.before_request
 def before_request():
-	if current_user.is_authenticated:
-		current_user.last_seen = datetime.utcnow()
-		db.session.commit()
+	#static files skip the session, so shared caches can keep them
+	if request.endpoint != 'static' and current_user.is_authenticated:
+		presence.touch(current_user)
 
 @app.route('/layout')
 def layout():
-	users = User.query.all()
-	return render_template('layout.html', users=users)
+	return render_template('layout.html')
+
+# username prefix lookup for sidebar and suggestion widgets
+@app.route('/api/users')
+@login_required
+def user_lookup():
+	records = directory.search(request.args.get('q', ''), limit=min(request.args.get('limit', 10, type=int), 50))
+	return jsonify(users=[dict(record._asdict(), dp=url_for('static', filename='profile_pics/' + record.dp)) for record in records])
 
 @app.route('/market/welcome')
 def landing():
@@ -36,19 +56,77 @@ def home():
 	if form.validate_on_submit():
 		if form.image.data:
 			picture = post_img(form.image.data)
-			post = Post(title=form.title.data, content=form.content.data, image=picture, author=current_user)
+			post = Post(title=form.title.data, content=form.content.data, image=picture, processing=True, user_id=current_user.id)
 		else:
-			post = Post(title=form.title.data, content=form.content.data, author=current_user)
+			post = Post(title=form.title.data, content=form.content.data, user_id=current_user.id)
 		db.session.add(post)
 		db.session.commit()
+		if post.processing:
+			process_post_images(post, post.image)
 		flash('Your Post Has been Created!', 'info')
 		return redirect(url_for('home'))
 	hour = datetime.now().hour
 	greeting = "Good morning" if 5<=hour<12 else "Good afternoon" if hour<18 else "Good evening"
 	#posts = Post.query.filter_by(author=current_user).order_by(Post.date_posted.desc())
-	posts = Post.query.order_by(Post.date_posted.desc())
-	return render_template('home.html', posts=posts, title=current_user.username.title() + "'s Market", form=form, greeting=greeting)
+	posts, next_cursor = paginate_posts(Post.query, request.args.get('cursor'))
+	trending = [] if request.args.get('partial') else trending_tags()
+	return render_feed('home.html', posts, next_cursor, title=current_user.username.title() + "'s Market", form=form, greeting=greeting, trending=trending)
+
+
 
+# posts from the people you follow, plus your own
+@app.route('/following')
+@login_required
+def following():
+	posts, next_cursor = timeline_page(current_user, request.args.get('cursor'))
+	return render_feed('following.html', posts, next_cursor, title='Following')
+
+
+@app.route('/search')
+@login_required
+def search():
+	q = request.args.get('q', '').strip()
+	page = max(request.args.get('page', 1, type=int), 1)
+	sold = {'yes': True, 'no': False}.get(request.args.get('sold'))
+	currency = request.args.get('currency', app.config['DEFAULT_CURRENCY']).upper()
+	posts, has_more = search_posts(q, min_price=filter_amount(request.args.get('min_price', type=float), currency),
+		max_price=filter_amount(request.args.get('max_price', type=float), currency), currency=currency, sold=sold,
+		author=request.args.get('author'), page=page, per_page=page_size())
+	args = request.args.to_dict()
+	args.pop('page', None)
+	prev_url = url_for('search', page=page - 1, **args) if page > 1 else None
+	next_url = url_for('search', page=page + 1, **args) if has_more else None
+	return render_template('search.html', posts=posts, q=q, prev_url=prev_url, next_url=next_url,
+		currency=currency, currencies=CURRENCIES, title='Search', **viewer_context(posts))
+
+
+# items in one currency by price, cheapest first, optionally within a range.
+# every page is a range scan on the (sold, price_currency, price_amount) index
+@app.route('/browse')
+@login_required
+def browse():
+	currency = request.args.get('currency', app.config['DEFAULT_CURRENCY']).upper()
+	sold = request.args.get('sold') == 'yes'
+	query = Post.query.filter(Post.sold == sold, Post.price_currency == currency, Post.price_amount.isnot(None))
+	min_price = filter_amount(request.args.get('min_price', type=float), currency)
+	max_price = filter_amount(request.args.get('max_price', type=float), currency)
+	if min_price is not None:
+		query = query.filter(Post.price_amount >= min_price)
+	if max_price is not None:
+		query = query.filter(Post.price_amount <= max_price)
+	posts, next_cursor = paginate_by_price(query, request.args.get('cursor'),
+		descending=request.args.get('sort') == 'price_desc')
+	return render_feed('browse.html', posts, next_cursor, currency=currency, currencies=CURRENCIES, title='Browse')
+
+
+@app.route('/tag/<string:name>')
+@login_required
+def tag(name):
+	tag = Tag.query.filter_by(name=name.lower()).first_or_404()
+	tagged = Post.query.join(post_tag, post_tag.c.post_id == Post.id).filter(post_tag.c.tag_id == tag.id)
+	posts, next_cursor = paginate_posts(tagged, request.args.get('cursor'),
+		key=(post_tag.c.date_posted, post_tag.c.post_id))
+	return render_feed('tag.html', posts, next_cursor, tag=tag, title='#' + tag.name)
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -61,6 +139,7 @@ def register():
 		user = User(name=form.username.data, username=form.username.data.lower(), email=form.email.data, password=hashed_password)
 		db.session.add(user)
 		db.session.commit()
+		directory.invalidate()
 		flash(f'Account Created for {form.username.data}! You can now log in', 'info')
 		return redirect(url_for('login'))
 	return render_template('register.html', title="Register", form=form)
@@ -72,7 +151,8 @@ def login():
 	form = LoginForm()
 	if form.validate_on_submit():
 		user = User.query.filter_by(username=form.username.data.lower()).first()
-		if user and bcrypt.check_password_hash(user.password, form.password.data):
+		#an account that is being deleted can't sign back in
+		if user and bcrypt.check_password_hash(user.password, form.password.data) and not PurgeJob.purging_user(user.id):
 			login_user(user, remember=form.remember.data)
 			next_page = request.args.get('next')
 			return redirect(next_page) if next_page else redirect(url_for('home'))
@@ -87,6 +167,45 @@ def logout():
 	return redirect(url_for('home'))
 
 
+# the email is queued in the outbox with the request's transaction and sent
+# in the background (see market/outbox.py)
+def send_reset_email(user):
+	token = user.get_reset_token()
+	enqueue('Password Reset Request', [user.email], render_template('email/reset_password.txt', user=user,
+		url=url_for('reset_token', token=token, _external=True)))
+
+@app.route('/reset_password', methods=['GET', 'POST'])
+def reset_request():
+	if current_user.is_authenticated:
+		return redirect(url_for('home'))
+	form = RequestResetForm()
+	if form.validate_on_submit():
+		user = User.query.filter_by(email=form.email.data).first()
+		if user:
+			send_reset_email(user)
+			db.session.commit()
+		#the same answer either way, so the form can't be used to find accounts
+		flash('If an account uses that email, instructions to reset the password are on their way.', 'info')
+		return redirect(url_for('login'))
+	return render_template('reset_request.html', title='Reset Password', form=form)
+
+@app.route('/reset_password/<token>', methods=['GET', 'POST'])
+def reset_token(token):
+	if current_user.is_authenticated:
+		return redirect(url_for('home'))
+	user = User.verify_reset_token(token)
+	if user is None:
+		flash('That is an invalid or expired token.', 'warning')
+		return redirect(url_for('reset_request'))
+	form = ResetPasswordForm()
+	if form.validate_on_submit():
+		user.password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+		db.session.commit()
+		flash('Your password has been updated! You can now log in', 'info')
+		return redirect(url_for('login'))
+	return render_template('reset_token.html', title='Reset Password', form=form)
+
+
 @app.route('/post/new', methods=['GET', 'POST'])
 @login_required
 def new_post():
@@ -94,9 +213,10 @@ def new_post():
 	if form.validate_on_submit():
 			picture = post_img(form.image.data)
 			post = Post(title=form.title.data, content=form.content.data, sold=form.sold.data, image=picture,\
-				tags=form.tags.data, price=form.price.data, author=current_user)
+				tags=form.tags.data, price=form.price.data, processing=True, user_id=current_user.id)
 			db.session.add(post)
 			db.session.commit()
+			process_post_images(post, post.image)
 			flash('Your Post Has been Created!', 'info')
 			return redirect(url_for('home'))
 	return render_template('create_post.html', title='New Post', form=form)
@@ -105,15 +225,14 @@ def new_post():
 @login_required
 def post(post_id):
 	post = Post.query.get_or_404(post_id)
-	users = User.query.all()
 	form = CommentForm()
 	if form.validate_on_submit():
-		comment = Comment(body=form.body.data, post=post, author=current_user)
+		comment = Comment(body=form.body.data, post=post, user_id=current_user.id)
 		db.session.add(comment)
 		db.session.commit()
 		flash('Your comment has been published.')
 		return redirect(url_for('post', post_id=post.id))
-	return render_template('post.html',title=post.title, post=post, form=form, users=users)
+	return render_template('post.html',title=post.title, post=post, form=form, **viewer_context([post]))
 
 
 
@@ -130,9 +249,14 @@ def update_post(post_id):
 		post.tags = form.tags.data
 		post.price = form.price.data
 		post.sold = form.sold.data
+		post.updated_at = datetime.utcnow()
 		if form.image.data:
 			post.image = post_img(form.image.data)
+			post.processing, post.image_failed = True, False
 		db.session.commit()
+		invalidate_post(post)
+		if post.processing:
+			process_post_images(post, post.image)
 		flash('Your post has been updated!', 'info')
 		return redirect(url_for('post', post_id=post.id))
 	elif request.method == 'GET':
@@ -152,8 +276,8 @@ def delete_post(post_id):
 	post = Post.query.get_or_404(post_id)
 	if post.author != current_user:
 		abort(403)
-	db.session.delete(post)
-	db.session.commit()
+	purge_post(post, requested_by=current_user.id)
+	invalidate_post(post)
 	flash('Your post has been deleted!', 'info')
 	return redirect(url_for('home'))
 
@@ -163,8 +287,10 @@ def delete_post(post_id):
 def like_action(post_id, action):
 	post = Post.query.filter_by(id=post_id).first_or_404()
 	if action == 'like':
-		current_user.like_post(post)
+		liked = current_user.like_post(post)
 		db.session.commit()
+		if liked:
+			push_like(post, current_user)
 	if action == 'unlike':
 		current_user.unlike_post(post)
 		db.session.commit()
@@ -175,29 +301,28 @@ def like_action(post_id, action):
 def likes(username):
 	username = username.lower()
 	user = User.query.filter_by(username=username).first_or_404()
-	posts = Post.query.order_by(Post.date_posted.desc())
-	users = User.query.all()
-	liked_people = set()
-	for post in posts:
-		if user.has_liked_post(post):
-			liked_people.add(post.author)
-	return render_template('user_likes.html', user=user, posts=posts, users=users, liked_people=liked_people, title= user.username.title() + "'s Likes")
+	liked_posts = Post.query.join(PostLike, PostLike.post_id == Post.id).filter(PostLike.user_id == user.id)
+	posts, next_cursor = paginate_posts(liked_posts, request.args.get('cursor'))
+	liked_people = [] if request.args.get('partial') else user.liked_authors(current_user)
+	return render_feed('user_likes.html', posts, next_cursor, user=user, liked_people=liked_people, title= user.username.title() + "'s Likes")
 
 @app.route('/account', methods=['GET', 'POST'])
 @login_required
 def account():
 	form = UpdateAccountForm()
 	if form.validate_on_submit():
-		if form.picture.data:
-			pic = profile_img(form.picture.data)
-			current_user.dp = pic
-		current_user.name = form.name.data
-		current_user.username = form.username.data.lower()
-		current_user.bio = form.bio.data
-		current_user.email = form.email.data
-		current_user.location = form.location.data
-		current_user.contact = form.contact.data
+		pic = profile_img(form.picture.data) if form.picture.data else None
+		user = current_user.model
+		user.name = form.name.data
+		user.username = form.username.data.lower()
+		user.bio = form.bio.data
+		user.email = form.email.data
+		user.location = form.location.data
+		user.contact = form.contact.data
 		db.session.commit()
+		if pic:
+			process_profile_image(user, pic)
+		directory.invalidate()
 		flash('Your Account has been updated', 'success')
 		return redirect(url_for('account'))
 	elif request.method == 'GET':
@@ -215,65 +340,62 @@ def account():
 def user_posts(username):
 	username = username.lower()
 	user = User.query.filter_by(username=username).first_or_404()
-	users = User.query.all()
-	posts = Post.query.filter_by(author=user).order_by(Post.date_posted.desc())
-	return render_template('profile.html', user=user, users=users,posts=posts, title=user.name.title())
+	authored = Post.query.filter_by(author=user)
+	posts, next_cursor = paginate_posts(authored, request.args.get('cursor'))
+	if request.args.get('partial'):
+		return render_feed('profile.html', posts, next_cursor, user=user)
+	#follow state for the follow buttons and both lists in two queries, not one per person
+	follower_list, followed_list = user.followers.all(), user.followed.all()
+	following_ids = current_user.following_ids([user.id] + [follower.id for follower in follower_list])
+	follower_ids = current_user.follower_ids([followed.id for followed in followed_list])
+	return render_feed('profile.html', posts, next_cursor, user=user, title=user.name.title(),
+		follower_list=follower_list, followed_list=followed_list, following_ids=following_ids, follower_ids=follower_ids)
 
 @app.route('/m/<recipient>', methods=['GET', 'POST'])
 @login_required
 def message(recipient):
-	current_user.last_message_read_time = datetime.utcnow()
-	db.session.commit()
 	recipient = recipient.lower()
 	user = User.query.filter_by(username=recipient).first_or_404()
-	current_user.last_message_read_time = datetime.utcnow()
-	db.session.commit()
 	#if user == current_user:
 		#return redirect(url_for('messages'))
 	form = MessageForm()
 	if form.validate_on_submit():
-		msg = m(author=current_user, recipient=user, body=form.message.data)
+		msg = m(sender_id=current_user.id, recipient=user, body=form.message.data)
 		db.session.add(msg)
 		db.session.commit()
+		push_message(msg)
+		#sent from the open chat without a reload
+		if request.args.get('partial'):
+			return jsonify(message=message_payload(msg))
 		flash('Your message has been sent.', 'info')
 		return redirect(url_for('message', recipient=recipient))
-	sent = current_user.messages_sent.filter_by(recipient_id=user.id)
-	received = current_user.messages_received.filter_by(sender_id=user.id)
-	messages = sent.union(received).order_by(m.timestamp.asc())
+	#only write when there is something to mark as read
+	conversation = Conversation.between(current_user, user)
+	if conversation and conversation.unread_for(current_user):
+		conversation.mark_read(current_user)
+		current_user.model.last_message_read_time = datetime.utcnow()
+		db.session.commit()
+	thread = m.query.filter(or_(
+		and_(m.sender_id == current_user.id, m.recipient_id == user.id),
+		and_(m.sender_id == user.id, m.recipient_id == current_user.id)))
+	messages, older_cursor = paginate_thread(thread, request.args.get('before'))
 
-	#adding all names of people who texted me to recent chats
-	messages_received = current_user.messages_received.order_by(m.timestamp.desc())
-	messages_sent = current_user.messages_sent.order_by(m.timestamp.desc())
-	recent_chats = list()
-	for message in messages_received:
-		recent_chats.append(message.author)
-	for message in messages_sent:
-		recent_chats.append(message.recipient)
-	recent_chats = list(dict.fromkeys(recent_chats))
+	#people I have chatted with, most recent first
+	recent_chats = [chat.other(current_user) for chat in Conversation.inbox(current_user)]
 
-	return render_template('send_message.html', recipient=recipient, title="Chat with " + recipient.title() , user=user, form=form, messages=messages, recent_chats=recent_chats)
+	return render_template('send_message.html', recipient=recipient, title="Chat with " + recipient.title() , user=user, form=form, messages=messages, older_cursor=older_cursor, recent_chats=recent_chats)
 
 
 @app.route('/messages')
 @login_required
 def messages():
-	current_user.last_message_read_time = datetime.utcnow()
-	db.session.commit()
-	messages_received = current_user.messages_received.order_by(m.timestamp.desc())
-	messages_sent = current_user.messages_sent.order_by(m.timestamp.desc())
-
-	#recent chats
-	recent_chats = list()
-	for message in messages_received:
-		recent_chats.append(message.author)
-	for message in messages_sent:
-		recent_chats.append(message.recipient)
-	recent_chats = list(dict.fromkeys(recent_chats))
-
-	users = User.query.all()
+	conversations = Conversation.inbox(current_user)
+	following = current_user.following_ids([chat.other(current_user).id for chat in conversations])
+
+	mutuals = directory.get_many(current_user.mutual_follow_ids()).values()
 	hour = datetime.now().hour
 	greeting = "Good morning" if 5<=hour<12 else "Good afternoon" if hour<18 else "Good evening"
-	return render_template('messages.html', users=users, greeting=greeting, recent_chats=recent_chats, messages_sent=messages_sent, messages_received=messages_received)
+	return render_template('messages.html', mutuals=mutuals, greeting=greeting, conversations=conversations, following=following)
 
 @app.route('/follow/<username>')
 @login_required
@@ -286,8 +408,9 @@ def follow(username):
 	if user == current_user:
 		flash('You cannot follow yourself!', 'danger')
 		return redirect(request.referrer)
-	current_user.follow(user)
+	current_user.model.follow(user)
 	db.session.commit()
+	backfill_timeline(current_user, user)
 	flash('💛 You are following {}!'.format(username.title()), 'info')
 	return redirect(request.referrer)
 
@@ -303,8 +426,9 @@ def unfollow(username):
 	if user == current_user:
 		flash('You cannot unfollow yourself!', 'danger')
 		return redirect(url_for('user_posts', username=username))
-	current_user.unfollow(user)
+	current_user.model.unfollow(user)
 	db.session.commit()
+	prune_timeline(current_user, user)
 	flash('💔 You are not following {}.'.format(username.title()), 'info')
 	return redirect(url_for('user_posts', username=username))
 
@@ -313,23 +437,46 @@ def unfollow(username):
 @app.route('/account/delete')
 @login_required
 def delete_account():
-	db.session.delete(current_user)
-	db.session.commit()
-	flash('Your account has been successfully deleted.', 'success')
+	#the account is removed in the background (see market/purge.py)
+	purge_user(current_user.model, requested_by=current_user.id)
+	logout_user()
+	flash('Your account is being deleted.', 'success')
 	return redirect(url_for('home'))
 
 @app.route('/admin/delete/<string:username>')
 @login_required
 def admin_delete_account(username):
 	username = username.lower()
-	user = User.query.filter_by(username=username).first()
+	user = User.query.filter_by(username=username).first_or_404()
 	if current_user.username == 'harun':
-		db.session.delete(user)
-		db.session.commit()
-		flash('Account Successfully deleted by Admin.', 'info')
+		purge_user(user, requested_by=current_user.id)
+		flash('Account deletion started by Admin.', 'info')
 	return redirect(url_for('home', user=user))
 
 
+@app.route('/admin/queues')
+@login_required
+def admin_queues():
+	if current_user.username != 'harun':
+		abort(403)
+	return jsonify(queues=[task_queue.stats() for task_queue in queues])
+
+@app.route('/admin/purges')
+@login_required
+def admin_purges():
+	if current_user.username != 'harun':
+		abort(403)
+	jobs = PurgeJob.query.order_by(PurgeJob.id.desc()).limit(50)
+	return jsonify(purges=[job.to_dict() for job in jobs])
+
+@app.route('/admin/purges/<int:job_id>')
+@login_required
+def admin_purge(job_id):
+	if current_user.username != 'harun':
+		abort(403)
+	return jsonify(PurgeJob.query.get_or_404(job_id).to_dict())
+
+
 #Error Handlers
 @app.errorhandler(404)
 def not_found_error(error):
@@ -0,0 +1,92 @@
+import re
+from sqlalchemy import DDL, func, literal_column, or_
+from sqlalchemy.sql import column, table
+from market import db
+from market.models import User, Post
+
+# full text index over post title, content and tags. it is an external content
+# fts5 table: it stores only the index and reads rows back from `post`, and
+# the triggers below keep it in step with every insert, update and delete.
+SEARCH_DDL = [
+	"CREATE VIRTUAL TABLE IF NOT EXISTS post_search USING fts5("
+	"title, content, tags, content='post', content_rowid='id', "
+	"tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+	"CREATE TRIGGER IF NOT EXISTS post_search_ai AFTER INSERT ON post BEGIN "
+	"INSERT INTO post_search(rowid, title, content, tags) VALUES (new.id, new.title, new.content, new.tags); END",
+	"CREATE TRIGGER IF NOT EXISTS post_search_ad AFTER DELETE ON post BEGIN "
+	"INSERT INTO post_search(post_search, rowid, title, content, tags) VALUES ('delete', old.id, old.title, old.content, old.tags); END",
+	"CREATE TRIGGER IF NOT EXISTS post_search_au AFTER UPDATE OF title, content, tags ON post BEGIN "
+	"INSERT INTO post_search(post_search, rowid, title, content, tags) VALUES ('delete', old.id, old.title, old.content, old.tags); "
+	"INSERT INTO post_search(rowid, title, content, tags) VALUES (new.id, new.title, new.content, new.tags); END",
+]
+
+# the table comes with the schema: the migration creates it, and so does
+# db.create_all() through these hooks on the post table
+for statement in SEARCH_DDL:
+	db.event.listen(Post.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+post_search = table('post_search', column('rowid'))
+
+# column weights for bm25: a hit in the title or tags counts more than the body
+RANK = func.bm25(literal_column('post_search'), 10.0, 1.0, 5.0)
+
+
+def fts_supported():
+	return db.engine.dialect.name == 'sqlite'
+
+# whether each database has its search table, looked up once per process. a
+# database made without it searches with LIKE until `flask
+# rebuild-search-index` adds it
+search_tables = {}
+
+def fts_available():
+	url = str(db.engine.url)
+	if url not in search_tables:
+		search_tables[url] = fts_supported() and db.engine.has_table('post_search')
+	return search_tables[url]
+
+def create_search_index():
+	for statement in SEARCH_DDL:
+		db.session.execute(statement)
+	db.session.commit()
+	search_tables[str(db.engine.url)] = True
+
+# re-index every post from scratch, e.g. after a bulk import
+def rebuild_search_index():
+	create_search_index()
+	db.session.execute("INSERT INTO post_search(post_search) VALUES ('rebuild')")
+	db.session.execute("INSERT INTO post_search(post_search) VALUES ('optimize')")
+	db.session.commit()
+
+# user input is never passed to MATCH as syntax: every word is quoted and
+# prefix matched, and all words must appear
+def match_expression(q):
+	terms = re.findall(r'\w+', q.lower())
+	return ' '.join('"{}"*'.format(term) for term in terms[:10])
+
+# min_price and max_price are in minor units of `currency` (see market/prices.py)
+def search_posts(q, min_price=None, max_price=None, currency=None, sold=None, author=None, page=1, per_page=24):
+	expression = match_expression(q)
+	if not expression:
+		return [], False
+	query = Post.query
+	if fts_available():
+		query = query.join(post_search, post_search.c.rowid == Post.id).filter(
+			literal_column('post_search').op('MATCH')(expression)).order_by(RANK, Post.id.desc())
+	else:
+		for term in re.findall(r'\w+', q)[:10]:
+			like = '%{}%'.format(term)
+			query = query.filter(or_(Post.title.ilike(like), Post.content.ilike(like), Post.tags.ilike(like)))
+		query = query.order_by(Post.date_posted.desc(), Post.id.desc())
+	if min_price is not None or max_price is not None:
+		query = query.filter(Post.price_currency == currency)
+	if min_price is not None:
+		query = query.filter(Post.price_amount >= min_price)
+	if max_price is not None:
+		query = query.filter(Post.price_amount <= max_price)
+	if sold is not None:
+		query = query.filter(Post.sold == sold)
+	if author:
+		query = query.join(User, User.id == Post.user_id).filter(User.username == author.lower())
+	posts = query.options(db.joinedload(Post.author)).offset((page - 1) * per_page).limit(per_page + 1).all()
+	return posts[:per_page], len(posts) > per_page
@@ -0,0 +1,186 @@
+import io
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+from PIL import Image
+from sqlalchemy import func, select
+from market import db, bcrypt
+from market.models import User, Post, PostLike, Comment, Message, Conversation, Tag, StoredImage, followers, post_tag
+from market.markup import render_markdown
+from market.images import stage_image, process_image
+from market.timeline import rebuild_timelines
+
+# synthetic data for load testing. rows are written with bulk Core inserts,
+# so none of the mapper events run; everything they would have maintained
+# (counters, post_tag, conversations, image refcounts, timelines) is worked
+# out here instead. activity is skewed the way a real market is: a few
+# sellers hold most of the posts and followers, and recent and popular posts
+# collect most of the likes and comments.
+
+FIRST_NAMES = ['amina', 'ali', 'deniz', 'elif', 'fatma', 'hasan', 'ian', 'jana', 'kemal', 'lena', 'mehmet',
+	'nora', 'omar', 'selin', 'tom', 'yusuf', 'zeynep', 'can', 'ece', 'burak']
+LAST_NAMES = ['kaya', 'demir', 'smith', 'yilmaz', 'ozturk', 'mwangi', 'otieno', 'aydin', 'celik', 'sahin']
+ITEMS = [('moncler jacket', 'fashion winter'), ('iphone 12', 'phone apple'), ('macbook air', 'laptop apple'),
+	('road bike', 'bike sport'), ('ikea desk', 'furniture home'), ('nike air max', 'shoes fashion'),
+	('ps5 controller', 'gaming console'), ('canon eos 80d', 'camera photo'), ('study lamp', 'home dorm'),
+	('calculus textbook', 'books dorm'), ('mini fridge', 'dorm home'), ('guitar', 'music'),
+	('winter boots', 'shoes winter'), ('airpods pro', 'apple audio'), ('office chair', 'furniture')]
+CONDITIONS = ['Barely used.', 'Like new, with the box.', 'A few scratches, works fine.',
+	'**Price is negotiable.**', 'Pickup on campus only.', 'Moving out, must go this week.']
+COMMENTS = ['Is this still available?', 'Would you take less?', 'Can I see it tomorrow?', 'DMed you!',
+	'What size is it?', 'Sold?']
+MESSAGES = ['Hi, is the {} still for sale?', 'Can you do a better price?', 'Sure, when can you meet?',
+	'Tomorrow after class works.', 'Great, see you then.', 'Thanks!']
+COLOURS = ['#e74c3c', '#3498db', '#2ecc71', '#f1c40f', '#9b59b6', '#1abc9c', '#34495e', '#e67e22']
+BATCH = 5000
+
+
+def _insert(table, rows):
+	for start in range(0, len(rows), BATCH):
+		db.session.execute(table.insert(), rows[start:start + BATCH])
+
+def _next_id(model):
+	return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+# a long tail: most weights are small and a few are very large
+def _skewed(rng, n, alpha=1.2):
+	return [rng.paretovariate(alpha) for _ in range(n)]
+
+def _when(rng, now, days):
+	#newer activity is more common than old
+	return now - timedelta(seconds=int(days * 86400 * rng.random() ** 2))
+
+# a few solid colour photos, pushed through the normal upload pipeline so
+# they have their variants and manifest
+def placeholder_images():
+	names = []
+	for colour in COLOURS:
+		data = io.BytesIO()
+		Image.new('RGB', (800, 800), colour).save(data, 'JPEG')
+		data.seek(0)
+		picture_fn = stage_image(data, 'posts')
+		process_image('posts', picture_fn)
+		names.append(picture_fn)
+	return names
+
+
+def seed(users=200, posts=2000, follows=15, likes=10000, comments=2000, messages=3000, days=180, seed=1, log=print):
+	rng = random.Random(seed)
+	now = datetime.utcnow()
+	password = bcrypt.generate_password_hash('password').decode('utf-8')
+
+	first_user = _next_id(User)
+	user_ids = list(range(first_user, first_user + users))
+	user_rows = []
+	for user_id in user_ids:
+		first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+		bio = rng.choice(['', 'Selling what I no longer need.', 'Student, *fair prices*.'])
+		user_rows.append({'id': user_id, 'name': '{} {}'.format(first, last).title(),
+			'username': '{}{}'.format(first, user_id)[:20], 'email': 'seed{}@example.com'.format(user_id),
+			'bio': bio or None, 'bio_html': render_markdown(bio, 'bio') if bio else None, 'dp': 'default.png',
+			'password': password, 'date_joined': _when(rng, now, days), 'last_seen': _when(rng, now, 7),
+			'followers_count': 0, 'following_count': 0, 'posts_count': 0})
+	by_user = {row['id']: row for row in user_rows}
+	popularity = dict(zip(user_ids, _skewed(rng, users)))
+
+	#follows: how many people each user follows is skewed, and popular
+	#sellers are more likely to be picked
+	follow_rows = []
+	weights = [popularity[user_id] for user_id in user_ids]
+	for user_id in user_ids:
+		wanted = min(users - 1, int(rng.expovariate(1.0 / follows)))
+		chosen = set()
+		for followed_id in rng.choices(user_ids, weights=weights, k=wanted * 2):
+			if len(chosen) >= wanted:
+				break
+			if followed_id != user_id:
+				chosen.add(followed_id)
+		for followed_id in chosen:
+			follow_rows.append({'follower_id': user_id, 'followed_id': followed_id})
+			by_user[user_id]['following_count'] += 1
+			by_user[followed_id]['followers_count'] += 1
+
+	images = placeholder_images()
+	tag_ids = {name: tag_id for tag_id, name in db.session.query(Tag.id, Tag.name)}
+	first_post = _next_id(Post)
+	post_rows, tag_rows, image_refs = [], [], Counter()
+	for post_id, user_id in zip(range(first_post, first_post + posts), rng.choices(user_ids, weights=weights, k=posts)):
+		title, tags = rng.choice(ITEMS)
+		content = '{} {}'.format(title.capitalize() + '.', rng.choice(CONDITIONS))
+		date_posted = max(_when(rng, now, days), by_user[user_id]['date_joined'])
+		image = rng.choice(images)
+		image_refs[image] += 1
+		names = Tag.parse(tags)
+		dollars = rng.randint(1, 300) * 5
+		post_rows.append({'id': post_id, 'title': title.title(), 'content': content,
+			'content_html': render_markdown(content), 'image': image, 'price': '${}'.format(dollars),
+			'price_amount': dollars * 100, 'price_currency': 'USD',
+			'tags': ' '.join('#' + name for name in names), 'date_posted': date_posted, 'updated_at': date_posted,
+			'sold': rng.random() < 0.2, 'processing': False, 'image_failed': False, 'user_id': user_id, 'likes_count': 0, 'comments_count': 0})
+		for name in names:
+			if name not in tag_ids:
+				tag_ids[name] = db.session.execute(Tag.__table__.insert().values(name=name)).inserted_primary_key[0]
+			tag_rows.append({'post_id': post_id, 'tag_id': tag_ids[name], 'date_posted': date_posted})
+		by_user[user_id]['posts_count'] += 1
+
+	#likes and comments favour popular sellers' posts
+	post_weights = [popularity[row['user_id']] for row in post_rows]
+	like_rows, liked = [], set()
+	for user_id, row in zip(rng.choices(user_ids, k=likes), rng.choices(post_rows, weights=post_weights, k=likes)):
+		if (user_id, row['id']) not in liked:
+			liked.add((user_id, row['id']))
+			like_rows.append({'user_id': user_id, 'post_id': row['id']})
+			row['likes_count'] += 1
+	comment_rows = []
+	for user_id, row in zip(rng.choices(user_ids, k=comments), rng.choices(post_rows, weights=post_weights, k=comments)):
+		body = rng.choice(COMMENTS)
+		comment_rows.append({'body': body, 'body_html': render_markdown(body), 'user_id': user_id,
+			'post_id': row['id'], 'date_posted': max(_when(rng, now, days), row['date_posted'])})
+		row['comments_count'] += 1
+	_insert(User.__table__, user_rows)
+	_insert(followers, follow_rows)
+	log('{} users, {} follows'.format(len(user_rows), len(follow_rows)))
+	_insert(Post.__table__, post_rows)
+	_insert(post_tag, tag_rows)
+	_insert(PostLike.__table__, like_rows)
+	_insert(Comment.__table__, comment_rows)
+	stored = StoredImage.__table__
+	for image, count in image_refs.items():
+		updated = db.session.execute(stored.update().where(db.and_(stored.c.folder == 'posts',
+			stored.c.filename == image)).values(refcount=stored.c.refcount + count))
+		if not updated.rowcount:
+			db.session.execute(stored.insert().values(folder='posts', filename=image, refcount=count))
+	log('{} posts, {} likes, {} comments'.format(len(post_rows), len(like_rows), len(comment_rows)))
+
+	#messages come in threads: a few pairs talk a lot, most exchange a line or two
+	message_rows, conversations = [], {}
+	message_id = _next_id(Message)
+	while len(message_rows) < messages:
+		sender_id, recipient_id = rng.sample(user_ids, 2)
+		when = _when(rng, now, days)
+		item = rng.choice(ITEMS)[0]
+		for i in range(min(messages - len(message_rows), 1 + int(rng.expovariate(0.25)))):
+			body = rng.choice(MESSAGES).format(item)
+			when = min(when + timedelta(minutes=rng.randint(1, 600)), now)
+			message_rows.append({'id': message_id, 'sender_id': sender_id, 'recipient_id': recipient_id,
+				'body': body, 'body_html': render_markdown(body), 'timestamp': when})
+			user_a_id, user_b_id = Conversation.pair(sender_id, recipient_id)
+			conversation = conversations.setdefault((user_a_id, user_b_id), {'user_a_id': user_a_id,
+				'user_b_id': user_b_id, 'last_message_id': None, 'last_timestamp': when, 'unread_a': 0, 'unread_b': 0})
+			if when >= conversation['last_timestamp'] or conversation['last_message_id'] is None:
+				conversation.update(last_message_id=message_id, last_timestamp=when)
+			if rng.random() < 0.3:
+				conversation['unread_a' if recipient_id == user_a_id else 'unread_b'] += 1
+			message_id += 1
+			sender_id, recipient_id = recipient_id, sender_id
+	_insert(Message.__table__, message_rows)
+	_insert(Conversation.__table__, list(conversations.values()))
+	log('{} messages in {} conversations'.format(len(message_rows), len(conversations)))
+
+	if db.engine.dialect.name == 'postgresql':
+		for model in (User, Post, Message):
+			db.session.execute(select([func.setval(func.pg_get_serial_sequence(model.__tablename__, 'id'),
+				func.max(model.id))]))
+	db.session.commit()
+	rebuild_timelines()
+	log('timelines rebuilt')
@@ -0,0 +1,26 @@
+from datetime import datetime, timedelta
+from market import app, db
+from market.cache import TTLCache
+from market.models import Tag, post_tag
+
+trending = TTLCache(maxsize=16, ttl=app.config['TRENDING_TAGS_TTL'])
+
+
+# most used tags on posts from the last TRENDING_TAGS_WINDOW days, as
+# (name, count) pairs. recomputed at most once every TRENDING_TAGS_TTL seconds
+def trending_tags(limit=10):
+	tags = trending.get(limit)
+	if tags is None:
+		since = datetime.utcnow() - timedelta(days=app.config['TRENDING_TAGS_WINDOW'])
+		#count over the date_posted range first, then look up the few names.
+		#grouping on tag_id + 0 keeps sqlite from walking the whole tag_id
+		#index for the grouping instead of searching the date range
+		uses = db.func.count().label('uses')
+		tag_id = (post_tag.c.tag_id + 0).label('tag_id')
+		top = db.session.query(tag_id, uses).filter(post_tag.c.date_posted >= since).group_by(
+			tag_id).order_by(uses.desc(), tag_id).limit(limit).subquery()
+		rows = db.session.query(Tag.name, top.c.uses).join(top, top.c.tag_id == Tag.id).order_by(
+			top.c.uses.desc(), Tag.name)
+		tags = [(name, count) for name, count in rows]
+		trending.set(limit, tags)
+	return tags
@@ -0,0 +1,99 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+from market import db
+
+try:
+	from eventlet import patcher, tpool
+except ImportError:
+	patcher = tpool = None
+
+# every queue in this process, for /admin/queues and /metrics
+queues = []
+
+# run a blocking call, e.g. Pillow resizing, on a real os thread. under the
+# eventlet workers (see gunicorn.conf.py) the queue threads below are green
+# threads on the worker's hub, and cpu bound work there would stall every
+# request and open socket of that worker until it finished
+def off_hub(func, *args, **kwargs):
+	if patcher is None or not patcher.is_monkey_patched('thread'):
+		return func(*args, **kwargs)
+	return tpool.execute(func, *args, **kwargs)
+
+# a bounded in-process job queue drained by a pool of worker threads. jobs run
+# inside an app context with their own db session. submit() returns False
+# when the queue is full so callers can fall back to doing the work inline.
+class TaskQueue(object):
+
+	def __init__(self, app, name, workers, maxsize):
+		self.app = app
+		self.name = name
+		self.workers = workers
+		self.jobs = queue.Queue(maxsize=maxsize)
+		self.threads = []
+		self.pid = None
+		self.lock = threading.Lock()
+		self.waits = deque(maxlen=1000)
+		self.counts = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+		queues.append(self)
+
+	def submit(self, func, *args, **kwargs):
+		if self.workers < 1:
+			return False
+		self.ensure_running()
+		try:
+			self.jobs.put_nowait((time.monotonic(), func, args, kwargs))
+		except queue.Full:
+			self.counts['rejected'] += 1
+			return False
+		self.counts['submitted'] += 1
+		return True
+
+	# run the job here and now, e.g. when the queue is full or disabled
+	def run_inline(self, func, *args, **kwargs):
+		return func(*args, **kwargs)
+
+	def submit_or_run(self, func, *args, **kwargs):
+		if not self.submit(func, *args, **kwargs):
+			self.run_inline(func, *args, **kwargs)
+
+	# started lazily so each gunicorn worker gets its own threads after the fork
+	def ensure_running(self):
+		if self.threads and self.pid == os.getpid():
+			return
+		with self.lock:
+			if self.threads and self.pid == os.getpid():
+				return
+			self.pid = os.getpid()
+			self.threads = [threading.Thread(target=self.work, name='{}-{}'.format(self.name, i), daemon=True)
+				for i in range(self.workers)]
+			for thread in self.threads:
+				thread.start()
+
+	def work(self):
+		while True:
+			queued_at, func, args, kwargs = self.jobs.get()
+			self.waits.append(time.monotonic() - queued_at)
+			with self.app.app_context():
+				try:
+					func(*args, **kwargs)
+					self.counts['completed'] += 1
+				except Exception:
+					self.counts['failed'] += 1
+					db.session.rollback()
+					self.app.logger.exception('%s job %s failed', self.name, getattr(func, '__name__', func))
+				finally:
+					db.session.remove()
+					self.jobs.task_done()
+
+	def stats(self):
+		waits = sorted(self.waits)
+		return dict(self.counts,
+			name=self.name,
+			workers=self.workers,
+			depth=self.jobs.qsize(),
+			max_depth=self.jobs.maxsize,
+			wait_p50_ms=round(waits[len(waits) // 2] * 1000, 1) if waits else 0,
+			wait_max_ms=round(waits[-1] * 1000, 1) if waits else 0)
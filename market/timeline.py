@@ -0,0 +1,106 @@
+from sqlalchemy import and_, literal, select
+from market import app, db
+from market.models import User, Post, followers, timeline
+from market.pagination import encode_cursor, page_size, paginate_posts
+from market.tasks import TaskQueue
+
+# fan-out on write: a new post is copied into the timeline of its author and
+# of everyone following them, so reading the following feed is a range scan
+# on (user_id, date_posted, post_id). sellers with more than
+# TIMELINE_FANOUT_LIMIT followers are not copied; their posts are merged in
+# when the feed is read. timelines keep TIMELINE_MAX_ENTRIES rows, and pages
+# past the end of a timeline are built from followers and post directly.
+timeline_queue = TaskQueue(app, 'timeline', 1, 1000)
+
+
+def enabled():
+	return app.config['TIMELINE_ENABLED']
+
+def fans_out(followers_count):
+	return followers_count <= app.config['TIMELINE_FANOUT_LIMIT']
+
+@db.event.listens_for(Post, 'after_insert')
+def fan_out(mapper, connection, target):
+	if not enabled():
+		return
+	connection.execute(timeline.insert().values(user_id=target.user_id, post_id=target.id,
+		author_id=target.user_id, date_posted=target.date_posted))
+	followers_count = connection.execute(select([User.__table__.c.followers_count]).where(
+		User.__table__.c.id == target.user_id)).scalar()
+	copied = bool(followers_count) and fans_out(followers_count)
+	if copied:
+		connection.execute(timeline.insert().from_select(['user_id', 'post_id', 'author_id', 'date_posted'],
+			select([followers.c.follower_id, literal(target.id), literal(target.user_id), literal(target.date_posted)]).where(
+				followers.c.followed_id == target.user_id)))
+	#trimming is not urgent, so it stays off the request
+	timeline_queue.submit(trim_timelines, target.user_id, copied)
+
+@db.event.listens_for(Post, 'after_delete')
+def remove_from_timelines(mapper, connection, target):
+	connection.execute(timeline.delete().where(timeline.c.post_id == target.id))
+
+
+# keep only the newest TIMELINE_MAX_ENTRIES rows of one timeline
+def trim_timeline(user_id):
+	newest = select([timeline.c.post_id]).where(timeline.c.user_id == user_id).order_by(
+		timeline.c.date_posted.desc(), timeline.c.post_id.desc()).limit(app.config['TIMELINE_MAX_ENTRIES'])
+	db.session.execute(timeline.delete().where(and_(timeline.c.user_id == user_id, ~timeline.c.post_id.in_(newest))))
+
+def trim_timelines(author_id, followers_too=True):
+	trim_timeline(author_id)
+	if followers_too:
+		for follower_id, in db.session.query(followers.c.follower_id).filter(followers.c.followed_id == author_id):
+			trim_timeline(follower_id)
+	db.session.commit()
+
+# call after the follow is committed: copy in the seller's recent posts
+def backfill_timeline(user, author):
+	if not enabled() or not fans_out(author.followers_count):
+		return
+	db.session.execute(timeline.delete().where(and_(timeline.c.user_id == user.id, timeline.c.author_id == author.id)))
+	recent = select([literal(user.id), Post.id, Post.user_id, Post.date_posted]).where(
+		Post.user_id == author.id).order_by(Post.date_posted.desc()).limit(app.config['TIMELINE_MAX_ENTRIES'])
+	db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'author_id', 'date_posted'], recent))
+	trim_timeline(user.id)
+	db.session.commit()
+
+def prune_timeline(user, author):
+	db.session.execute(timeline.delete().where(and_(timeline.c.user_id == user.id, timeline.c.author_id == author.id)))
+	db.session.commit()
+
+# start over from followers and post, e.g. after changing the limits
+def rebuild_timelines():
+	db.session.execute(timeline.delete())
+	for user_id, in db.session.query(User.id):
+		followed = db.session.query(User.id).join(followers, followers.c.followed_id == User.id).filter(
+			followers.c.follower_id == user_id, User.followers_count <= app.config['TIMELINE_FANOUT_LIMIT'])
+		recent = select([literal(user_id), Post.id, Post.user_id, Post.date_posted]).where(db.or_(
+			Post.user_id == user_id, Post.user_id.in_(followed))).order_by(
+				Post.date_posted.desc()).limit(app.config['TIMELINE_MAX_ENTRIES'])
+		db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'author_id', 'date_posted'], recent))
+	db.session.commit()
+
+
+def _sort_key(post):
+	return post.date_posted, post.id
+
+# one page of the posts by `user` and everyone they follow, newest first,
+# with the same cursor format as the other feeds
+def timeline_page(user, cursor=None, per_page=None):
+	per_page = per_page or page_size()
+	if enabled():
+		stored = Post.query.join(timeline, and_(timeline.c.post_id == Post.id, timeline.c.user_id == user.id))
+		posts, next_cursor = paginate_posts(stored, cursor, per_page,
+			key=(timeline.c.date_posted, timeline.c.post_id))
+		#a full page with more behind it never reaches rows that were trimmed
+		if next_cursor:
+			celebrities = db.session.query(User.id).join(followers, followers.c.followed_id == User.id).filter(
+				followers.c.follower_id == user.id, User.followers_count > app.config['TIMELINE_FANOUT_LIMIT'])
+			celebrity_ids = [user_id for user_id, in celebrities]
+			if celebrity_ids:
+				read, _ = paginate_posts(Post.query.filter(Post.user_id.in_(celebrity_ids)), cursor, per_page)
+				merged = {post.id: post for post in posts + read}
+				posts = sorted(merged.values(), key=_sort_key, reverse=True)[:per_page]
+				next_cursor = encode_cursor(posts[-1].date_posted, posts[-1].id)
+			return posts, next_cursor
+	return paginate_posts(user.followed_posts(), cursor, per_page)
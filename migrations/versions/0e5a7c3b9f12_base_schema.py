@@ -0,0 +1,98 @@
+"""base schema, the tables as they were before migrations
+
+Revision ID: 0e5a7c3b9f12
+Revises: 
+Create Date: 2026-10-18 10:05:12.118734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0e5a7c3b9f12'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases from before migrations already have these tables and no
+    # version; they start from here untouched. a new database gets them made
+    if 'user' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table('user',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('username', sa.String(length=20), nullable=False),
+    sa.Column('email', sa.String(length=120), nullable=False),
+    sa.Column('dp', sa.String(length=20), nullable=False),
+    sa.Column('location', sa.String(length=50), nullable=True),
+    sa.Column('contact', sa.String(length=50), nullable=True),
+    sa.Column('bio', sa.String(length=120), nullable=True),
+    sa.Column('password', sa.String(length=60), nullable=False),
+    sa.Column('date_joined', sa.DateTime(), nullable=False),
+    sa.Column('last_seen', sa.DateTime(), nullable=True),
+    sa.Column('last_message_read_time', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email'),
+    sa.UniqueConstraint('username')
+    )
+    op.create_table('followers',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.create_table('post',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('title', sa.String(length=100), nullable=True),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('image', sa.String(length=20), nullable=False),
+    sa.Column('image2', sa.String(length=20), nullable=True),
+    sa.Column('image3', sa.String(length=20), nullable=True),
+    sa.Column('price', sa.String(length=20), nullable=False),
+    sa.Column('tags', sa.String(length=100), nullable=True),
+    sa.Column('date_posted', sa.DateTime(), nullable=False),
+    sa.Column('sold', sa.Boolean(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('message',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sender_id', sa.Integer(), nullable=True),
+    sa.Column('recipient_id', sa.Integer(), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['recipient_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['sender_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_message_timestamp', 'message', ['timestamp'], unique=False)
+    op.create_table('post_like',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('post_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('comment',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('date_posted', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    # upgrade() can't tell whether it made these tables or found them with
+    # the data from before migrations, so they are never dropped here;
+    # downgrading to base stops at the original schema, which upgrade()
+    # then leaves alone again
+    pass
@@ -0,0 +1,53 @@
+"""pre-rendered html for bios, posts, comments and messages
+
+Revision ID: 2f6c8a4d1e93
+Revises: 7b3f9e21c6d4
+Create Date: 2026-10-18 17:58:31.204786
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from market.markup import render_markdown
+
+
+# revision identifiers, used by Alembic.
+revision = '2f6c8a4d1e93'
+down_revision = '7b3f9e21c6d4'
+branch_labels = None
+depends_on = None
+
+# (table, source column, html column, sanitizer policy)
+RENDERED_COLUMNS = [
+    ('user', 'bio', 'bio_html', 'bio'),
+    ('post', 'content', 'content_html', 'body'),
+    ('comment', 'body', 'body_html', 'body'),
+    ('message', 'body', 'body_html', 'body'),
+]
+
+
+def upgrade():
+    for table_name, source, target, policy in RENDERED_COLUMNS:
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.add_column(sa.Column(target, sa.Text(), nullable=True))
+
+    # render what is already stored so pages have html straight away
+    connection = op.get_bind()
+    for table_name, source, target, policy in RENDERED_COLUMNS:
+        table = sa.table(table_name, sa.column('id'), sa.column(source), sa.column(target))
+        rows = connection.execute(sa.select([table.c.id, table.c[source]])).fetchall()
+        updates = [{'row_id': row_id, 'html': render_markdown(text, policy)} for row_id, text in rows]
+        if updates:
+            connection.execute(table.update().where(table.c.id == sa.bindparam('row_id')).values(
+                {target: sa.bindparam('html')}), updates)
+
+
+def downgrade():
+    for table_name, source, target, policy in reversed(RENDERED_COLUMNS):
+        with op.batch_alter_table(table_name, schema=None) as batch_op:
+            batch_op.drop_column(target)
+
+    # sqlite drops a column by copying the table, which loses its triggers
+    if op.get_bind().dialect.name == 'sqlite':
+        from market.search import SEARCH_DDL
+        for statement in SEARCH_DDL:
+            op.execute(statement)
@@ -0,0 +1,29 @@
+"""unique post_like per user and post
+
+Revision ID: 3c1d8e2f4a51
+Revises: 0e5a7c3b9f12
+Create Date: 2026-10-18 10:12:31.402511
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1d8e2f4a51'
+down_revision = '0e5a7c3b9f12'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # drop duplicate likes left behind by double clicks before the index existed
+    op.execute(
+        'DELETE FROM post_like WHERE id NOT IN '
+        '(SELECT MIN(id) FROM post_like GROUP BY user_id, post_id)'
+    )
+    op.create_index('ix_post_like_user_id_post_id', 'post_like', ['user_id', 'post_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_post_like_user_id_post_id', table_name='post_like')
@@ -0,0 +1,58 @@
+"""indexes for the feed, profile, follow, comment and thread queries
+
+Revision ID: 4c8f0a5e2b19
+Revises: 9d4e1b7a3c62
+Create Date: 2026-10-18 19:24:50.316058
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c8f0a5e2b19'
+down_revision = '9d4e1b7a3c62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # a double click on "follow" could store the same pair twice. the table
+    # has no id, so each dialect's row address picks the copy to keep
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute(
+            'DELETE FROM followers WHERE rowid NOT IN '
+            '(SELECT MIN(rowid) FROM followers GROUP BY follower_id, followed_id)'
+        )
+    elif dialect == 'postgresql':
+        #MIN(ctid) needs postgres 14; comparing ctids works on every version
+        op.execute(
+            'DELETE FROM followers a USING followers b WHERE a.follower_id = b.follower_id '
+            'AND a.followed_id = b.followed_id AND a.ctid > b.ctid'
+        )
+    # the follow counters were backfilled before the copies went
+    op.execute(
+        'UPDATE "user" SET '
+        'followers_count = (SELECT COUNT(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_count = (SELECT COUNT(*) FROM followers WHERE followers.follower_id = "user".id)'
+    )
+    op.create_index('ix_followers_follower_id_followed_id', 'followers', ['follower_id', 'followed_id'], unique=True)
+    op.create_index('ix_followers_followed_id_follower_id', 'followers', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_date_posted_id', 'post', ['date_posted', 'id'], unique=False)
+    op.create_index('ix_post_user_id_date_posted_id', 'post', ['user_id', 'date_posted', 'id'], unique=False)
+    op.create_index('ix_post_like_post_id', 'post_like', ['post_id'], unique=False)
+    op.create_index('ix_comment_post_id_date_posted', 'comment', ['post_id', 'date_posted'], unique=False)
+    op.create_index('ix_message_sender_id_recipient_id_timestamp', 'message', ['sender_id', 'recipient_id', 'timestamp'], unique=False)
+    op.create_index('ix_message_recipient_id_sender_id_timestamp', 'message', ['recipient_id', 'sender_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_recipient_id_sender_id_timestamp', table_name='message')
+    op.drop_index('ix_message_sender_id_recipient_id_timestamp', table_name='message')
+    op.drop_index('ix_comment_post_id_date_posted', table_name='comment')
+    op.drop_index('ix_post_like_post_id', table_name='post_like')
+    op.drop_index('ix_post_user_id_date_posted_id', table_name='post')
+    op.drop_index('ix_post_date_posted_id', table_name='post')
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    op.drop_index('ix_followers_follower_id_followed_id', table_name='followers')
@@ -0,0 +1,65 @@
+"""content addressed image storage with reference counts
+
+Revision ID: 5a0c2e9b7f44
+Revises: d91f3a7c5e28
+Create Date: 2026-10-18 14:52:16.230947
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a0c2e9b7f44'
+down_revision = 'd91f3a7c5e28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stored_image',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('folder', sa.String(length=20), nullable=False),
+    sa.Column('filename', sa.String(length=64), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.Column('created', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_stored_image_folder_filename', 'stored_image', ['folder', 'filename'], unique=True)
+
+    # sharded paths no longer fit in 20 characters
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.alter_column('image', existing_type=sa.String(length=20), type_=sa.String(length=64), existing_nullable=False)
+        batch_op.alter_column('image2', existing_type=sa.String(length=20), type_=sa.String(length=64), existing_nullable=True)
+        batch_op.alter_column('image3', existing_type=sa.String(length=20), type_=sa.String(length=64), existing_nullable=True)
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('dp', existing_type=sa.String(length=20), type_=sa.String(length=64), existing_nullable=False)
+
+    # count the references that already exist so gc never removes a file in use
+    op.execute(
+        "INSERT INTO stored_image (folder, filename, refcount, created) "
+        "SELECT 'posts', filename, COUNT(*), CURRENT_TIMESTAMP FROM ("
+        "  SELECT image AS filename FROM post"
+        "  UNION ALL SELECT image2 FROM post"
+        "  UNION ALL SELECT image3 FROM post"
+        ") AS refs WHERE filename IS NOT NULL GROUP BY filename"
+    )
+    op.execute(
+        "INSERT INTO stored_image (folder, filename, refcount, created) "
+        "SELECT 'profile_pics', dp, COUNT(*), CURRENT_TIMESTAMP FROM \"user\" "
+        "WHERE dp IS NOT NULL GROUP BY dp"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.alter_column('dp', existing_type=sa.String(length=64), type_=sa.String(length=20), existing_nullable=False)
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.alter_column('image3', existing_type=sa.String(length=64), type_=sa.String(length=20), existing_nullable=True)
+        batch_op.alter_column('image2', existing_type=sa.String(length=64), type_=sa.String(length=20), existing_nullable=True)
+        batch_op.alter_column('image', existing_type=sa.String(length=64), type_=sa.String(length=20), existing_nullable=False)
+
+    op.drop_index('ix_stored_image_folder_filename', table_name='stored_image')
+    op.drop_table('stored_image')
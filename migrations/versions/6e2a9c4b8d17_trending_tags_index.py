@@ -0,0 +1,27 @@
+"""covering post_tag index for trending tags
+
+Revision ID: 6e2a9c4b8d17
+Revises: b8d1e4f7a293
+Create Date: 2026-10-19 10:12:44.208113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6e2a9c4b8d17'
+down_revision = 'b8d1e4f7a293'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the trending window reads tag ids straight off the date range
+    op.drop_index('ix_post_tag_date_posted', table_name='post_tag')
+    op.create_index('ix_post_tag_date_posted_tag_id', 'post_tag', ['date_posted', 'tag_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_tag_date_posted_tag_id', table_name='post_tag')
+    op.create_index('ix_post_tag_date_posted', 'post_tag', ['date_posted'], unique=False)
@@ -0,0 +1,68 @@
+"""normalized tag table and post_tag index
+
+Revision ID: 7b3f9e21c6d4
+Revises: e6b84d1f0a37
+Create Date: 2026-10-18 16:41:09.518320
+
+"""
+import re
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3f9e21c6d4'
+down_revision = 'e6b84d1f0a37'
+branch_labels = None
+depends_on = None
+
+
+def parse_tags(text):
+    names = []
+    for name in re.findall(r'\w+', (text or '').lower()):
+        if name not in names:
+            names.append(name[:50])
+    return names[:10]
+
+
+def upgrade():
+    tag = op.create_table('tag',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('name')
+    )
+    post_tag = op.create_table('post_tag',
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.Column('date_posted', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ondelete='CASCADE')
+    )
+    op.create_index('ix_post_tag_post_id_tag_id', 'post_tag', ['post_id', 'tag_id'], unique=True)
+    op.create_index('ix_post_tag_tag_id_date_posted', 'post_tag', ['tag_id', 'date_posted', 'post_id'], unique=False)
+    op.create_index('ix_post_tag_date_posted', 'post_tag', ['date_posted'], unique=False)
+
+    # split the existing free-form tag strings into rows
+    connection = op.get_bind()
+    post = sa.table('post', sa.column('id'), sa.column('tags'), sa.column('date_posted', sa.DateTime))
+    tag_ids, links = {}, []
+    for post_id, tags, date_posted in connection.execute(sa.select([post.c.id, post.c.tags, post.c.date_posted])):
+        names = parse_tags(tags)
+        for name in names:
+            if name not in tag_ids:
+                tag_ids[name] = connection.execute(tag.insert().values(name=name)).inserted_primary_key[0]
+            links.append({'post_id': post_id, 'tag_id': tag_ids[name], 'date_posted': date_posted})
+        normalized = ' '.join('#' + name for name in names) or None
+        if normalized != tags:
+            connection.execute(post.update().where(post.c.id == post_id).values(tags=normalized))
+    if links:
+        connection.execute(post_tag.insert(), links)
+
+
+def downgrade():
+    op.drop_index('ix_post_tag_date_posted', table_name='post_tag')
+    op.drop_index('ix_post_tag_tag_id_date_posted', table_name='post_tag')
+    op.drop_index('ix_post_tag_post_id_tag_id', table_name='post_tag')
+    op.drop_table('post_tag')
+    op.drop_table('tag')
@@ -0,0 +1,51 @@
+"""denormalized like, comment, follow and post counters
+
+Revision ID: 8f2a6b0d9c13
+Revises: 3c1d8e2f4a51
+Create Date: 2026-10-18 11:03:54.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f2a6b0d9c13'
+down_revision = '3c1d8e2f4a51'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('likes_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('comments_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+
+    # backfill, same as `flask reconcile-counters`
+    op.execute(
+        'UPDATE post SET '
+        'likes_count = (SELECT COUNT(*) FROM post_like WHERE post_like.post_id = post.id), '
+        'comments_count = (SELECT COUNT(*) FROM comment WHERE comment.post_id = post.id)'
+    )
+    op.execute(
+        'UPDATE "user" SET '
+        'followers_count = (SELECT COUNT(*) FROM followers WHERE followers.followed_id = "user".id), '
+        'following_count = (SELECT COUNT(*) FROM followers WHERE followers.follower_id = "user".id), '
+        'posts_count = (SELECT COUNT(*) FROM post WHERE post.user_id = "user".id)'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('posts_count')
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('followers_count')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('comments_count')
+        batch_op.drop_column('likes_count')
@@ -0,0 +1,26 @@
+"""post image_failed flag for image jobs that gave up
+
+Revision ID: 9b3f5d1c7a60
+Revises: 6e2a9c4b8d17
+Create Date: 2026-10-19 11:40:27.516092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3f5d1c7a60'
+down_revision = '6e2a9c4b8d17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('image_failed', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('image_failed')
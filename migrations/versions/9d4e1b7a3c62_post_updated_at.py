@@ -0,0 +1,34 @@
+"""post updated_at, the version of cached post cards
+
+Revision ID: 9d4e1b7a3c62
+Revises: 2f6c8a4d1e93
+Create Date: 2026-10-18 18:36:12.771094
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4e1b7a3c62'
+down_revision = '2f6c8a4d1e93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+    op.execute('UPDATE post SET updated_at = date_posted')
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('updated_at')
+
+    # sqlite drops a column by copying the table, which loses its triggers
+    if op.get_bind().dialect.name == 'sqlite':
+        from market.search import SEARCH_DDL
+        for statement in SEARCH_DDL:
+            op.execute(statement)
@@ -0,0 +1,46 @@
+"""precomputed following timeline
+
+Revision ID: a7e5c3d9f021
+Revises: 4c8f0a5e2b19
+Create Date: 2026-10-18 20:12:37.904415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7e5c3d9f021'
+down_revision = '4c8f0a5e2b19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('author_id', sa.Integer(), nullable=False),
+    sa.Column('date_posted', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['author_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], )
+    )
+    op.create_index('ix_timeline_user_id_date_posted_post_id', 'timeline', ['user_id', 'date_posted', 'post_id'], unique=True)
+    op.create_index('ix_timeline_post_id', 'timeline', ['post_id'], unique=False)
+
+    # every user's own posts plus those of the people they follow;
+    # `flask rebuild-timelines` applies the per user cap
+    op.execute(
+        'INSERT INTO timeline (user_id, post_id, author_id, date_posted) '
+        'SELECT followers.follower_id, post.id, post.user_id, post.date_posted '
+        'FROM followers JOIN post ON post.user_id = followers.followed_id '
+        'UNION '
+        'SELECT post.user_id, post.id, post.user_id, post.date_posted FROM post'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_timeline_post_id', table_name='timeline')
+    op.drop_index('ix_timeline_user_id_date_posted_post_id', table_name='timeline')
+    op.drop_table('timeline')
@@ -0,0 +1,55 @@
+"""conversation index for the inbox
+
+Revision ID: b4e7c19a2d06
+Revises: 8f2a6b0d9c13
+Create Date: 2026-10-18 12:41:09.553870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e7c19a2d06'
+down_revision = '8f2a6b0d9c13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_a_id', sa.Integer(), nullable=False),
+    sa.Column('user_b_id', sa.Integer(), nullable=False),
+    sa.Column('last_message_id', sa.Integer(), nullable=True),
+    sa.Column('last_timestamp', sa.DateTime(), nullable=False),
+    sa.Column('unread_a', sa.Integer(), server_default='0', nullable=False),
+    sa.Column('unread_b', sa.Integer(), server_default='0', nullable=False),
+    sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], ),
+    sa.ForeignKeyConstraint(['user_a_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_b_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_conversation_user_a_id_user_b_id', 'conversation', ['user_a_id', 'user_b_id'], unique=True)
+    op.create_index('ix_conversation_user_a_id_last_timestamp', 'conversation', ['user_a_id', 'last_timestamp'], unique=False)
+    op.create_index('ix_conversation_user_b_id_last_timestamp', 'conversation', ['user_b_id', 'last_timestamp'], unique=False)
+
+    # one row per pair that has exchanged messages, pointing at the newest one.
+    # existing history counts as read.
+    op.execute(
+        'INSERT INTO conversation (user_a_id, user_b_id, last_message_id, last_timestamp, unread_a, unread_b) '
+        'SELECT pair.user_a_id, pair.user_b_id, message.id, message.timestamp, 0, 0 FROM ('
+        '  SELECT CASE WHEN sender_id < recipient_id THEN sender_id ELSE recipient_id END AS user_a_id,'
+        '         CASE WHEN sender_id < recipient_id THEN recipient_id ELSE sender_id END AS user_b_id,'
+        '         MAX(id) AS last_message_id'
+        '  FROM message WHERE sender_id IS NOT NULL AND recipient_id IS NOT NULL'
+        '  GROUP BY 1, 2'
+        ') AS pair JOIN message ON message.id = pair.last_message_id'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_conversation_user_b_id_last_timestamp', table_name='conversation')
+    op.drop_index('ix_conversation_user_a_id_last_timestamp', table_name='conversation')
+    op.drop_index('ix_conversation_user_a_id_user_b_id', table_name='conversation')
+    op.drop_table('conversation')
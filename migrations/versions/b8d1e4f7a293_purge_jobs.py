@@ -0,0 +1,65 @@
+"""purge jobs, cascading post foreign keys
+
+Revision ID: b8d1e4f7a293
+Revises: f3b9d6e2a814
+Create Date: 2026-10-18 23:02:17.640281
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8d1e4f7a293'
+down_revision = 'f3b9d6e2a814'
+branch_labels = None
+depends_on = None
+
+# sqlite's foreign keys have no names; batch mode finds them by this convention
+NAMING = {'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s'}
+
+
+def _post_fk(table):
+    for fk in sa.inspect(op.get_bind()).get_foreign_keys(table):
+        if fk['constrained_columns'] == ['post_id']:
+            return fk['name'] or 'fk_{}_post_id_post'.format(table)
+
+
+def _replace_post_fk(table, ondelete):
+    name = _post_fk(table)
+    with op.batch_alter_table(table, schema=None, naming_convention=NAMING) as batch_op:
+        batch_op.drop_constraint(name, type_='foreignkey')
+        batch_op.create_foreign_key('fk_{}_post_id_post'.format(table), 'post', ['post_id'], ['id'], ondelete=ondelete)
+
+
+def upgrade():
+    op.create_table('purge_job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('target_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=10), nullable=False),
+    sa.Column('stage', sa.String(length=20), nullable=True),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('deleted', sa.Integer(), nullable=False),
+    sa.Column('images', sa.Text(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('requested_by', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_purge_job_kind_target_id', 'purge_job', ['kind', 'target_id'], unique=False)
+    op.create_index('ix_comment_user_id', 'comment', ['user_id'], unique=False)
+
+    # a post's likes and comments go with it where foreign keys are enforced
+    _replace_post_fk('comment', 'CASCADE')
+    _replace_post_fk('post_like', 'CASCADE')
+
+
+def downgrade():
+    _replace_post_fk('post_like', None)
+    _replace_post_fk('comment', None)
+    op.drop_index('ix_comment_user_id', table_name='comment')
+    op.drop_index('ix_purge_job_kind_target_id', table_name='purge_job')
+    op.drop_table('purge_job')
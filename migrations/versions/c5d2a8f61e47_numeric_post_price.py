@@ -0,0 +1,55 @@
+"""numeric post price amount and currency
+
+Revision ID: c5d2a8f61e47
+Revises: a7e5c3d9f021
+Create Date: 2026-10-18 21:04:52.318640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+from market.prices import parse_price
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5d2a8f61e47'
+down_revision = 'a7e5c3d9f021'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('price_amount', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('price_currency', sa.String(length=3), nullable=True))
+
+    # prices that can't be read stay null and drop out of price sorts and filters
+    connection = op.get_bind()
+    post = sa.table('post', sa.column('id', sa.Integer), sa.column('price', sa.String),
+        sa.column('price_amount', sa.BigInteger), sa.column('price_currency', sa.String))
+    updates = []
+    for post_id, price in connection.execute(sa.select([post.c.id, post.c.price])):
+        try:
+            amount, currency = parse_price(price, current_app.config['DEFAULT_CURRENCY'])
+        except ValueError:
+            continue
+        updates.append({'post_id': post_id, 'amount': amount, 'currency': currency})
+    if updates:
+        connection.execute(post.update().where(post.c.id == sa.bindparam('post_id')).values(
+            price_amount=sa.bindparam('amount'), price_currency=sa.bindparam('currency')), updates)
+
+    op.create_index('ix_post_sold_price_currency_price_amount_date_posted_id', 'post',
+        ['sold', 'price_currency', 'price_amount', 'date_posted', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_sold_price_currency_price_amount_date_posted_id', table_name='post')
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('price_currency')
+        batch_op.drop_column('price_amount')
+
+    # sqlite drops a column by copying the table, which loses its triggers
+    if op.get_bind().dialect.name == 'sqlite':
+        from market.search import SEARCH_DDL
+        for statement in SEARCH_DDL:
+            op.execute(statement)
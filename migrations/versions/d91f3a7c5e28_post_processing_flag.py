@@ -0,0 +1,26 @@
+"""post processing flag for background image jobs
+
+Revision ID: d91f3a7c5e28
+Revises: b4e7c19a2d06
+Create Date: 2026-10-18 13:27:45.902113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91f3a7c5e28'
+down_revision = 'b4e7c19a2d06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('processing', sa.Boolean(), server_default=sa.false(), nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('processing')
@@ -0,0 +1,50 @@
+"""post full text search index
+
+Revision ID: e6b84d1f0a37
+Revises: 5a0c2e9b7f44
+Create Date: 2026-10-18 15:38:02.671530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6b84d1f0a37'
+down_revision = '5a0c2e9b7f44'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # fts5 is sqlite only; other databases search with LIKE (see market/search.py)
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute(
+        "CREATE VIRTUAL TABLE post_search USING fts5("
+        "title, content, tags, content='post', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    op.execute(
+        "CREATE TRIGGER post_search_ai AFTER INSERT ON post BEGIN "
+        "INSERT INTO post_search(rowid, title, content, tags) VALUES (new.id, new.title, new.content, new.tags); END"
+    )
+    op.execute(
+        "CREATE TRIGGER post_search_ad AFTER DELETE ON post BEGIN "
+        "INSERT INTO post_search(post_search, rowid, title, content, tags) VALUES ('delete', old.id, old.title, old.content, old.tags); END"
+    )
+    op.execute(
+        "CREATE TRIGGER post_search_au AFTER UPDATE OF title, content, tags ON post BEGIN "
+        "INSERT INTO post_search(post_search, rowid, title, content, tags) VALUES ('delete', old.id, old.title, old.content, old.tags); "
+        "INSERT INTO post_search(rowid, title, content, tags) VALUES (new.id, new.title, new.content, new.tags); END"
+    )
+    op.execute("INSERT INTO post_search(post_search) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER IF EXISTS post_search_au')
+    op.execute('DROP TRIGGER IF EXISTS post_search_ad')
+    op.execute('DROP TRIGGER IF EXISTS post_search_ai')
+    op.execute('DROP TABLE IF EXISTS post_search')
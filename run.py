@@ -1,4 +1,4 @@
-from market import app
+from market import app, socketio
 
 if __name__ == '__main__':
-	app.run(debug=True)
\ No newline at end of file
+	socketio.run(app, debug=True)
\ No newline at end of file